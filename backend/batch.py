@@ -0,0 +1,189 @@
+"""
+Turn a corpus of screen recordings into steps, the way /video-to-frames/
+does, without the HTTP server:
+
+    python batch.py recordings/ --output steps.jsonl --model gpt-4o
+    python batch.py manifest.txt --output steps.jsonl --workers 8 --concurrency 16
+
+The input is a directory (searched recursively) or a manifest listing one
+video path per line. Videos are decoded in a process pool and analyzed
+with bounded LLM concurrency; every result is appended to the output as
+one JSON line as soon as it is ready. The output doubles as the
+checkpoint: running the same command again skips the videos it already
+holds, so an interrupted run resumes where it stopped.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+import llm_client
+from utils import VideoOptions, analyze_video_windowed, parse_steps, process_video_with_stats
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".mkv", ".webm", ".avi")
+# Seconds between two progress lines
+REPORT_INTERVAL = 30
+
+
+def find_videos(source, extensions=VIDEO_EXTENSIONS):
+    """Video paths of a directory tree or a manifest file, in a stable order."""
+    if os.path.isdir(source):
+        return sorted(os.path.abspath(os.path.join(root, name)) for root, _, names in os.walk(source)
+                      for name in names if name.lower().endswith(extensions))
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source) as f:
+        lines = [line.strip() for line in f]
+    # Relative manifest entries are relative to the manifest
+    return [os.path.join(base, line) for line in lines if line and not line.startswith("#")]
+
+
+def load_checkpoint(output):
+    """
+    Records already in the output, by path. A line cut short by an
+    interrupted run is dropped from the file.
+    """
+    records = {}
+    if not os.path.exists(output):
+        return records
+    with open(output, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    for line in data[:end].splitlines():
+        if line.strip():
+            record = json.loads(line)
+            records[record["path"]] = record
+    return records
+
+
+@dataclass
+class BatchStats:
+    total: int = 0  # Videos to process in this run
+    done: int = 0
+    failed: int = 0
+    skipped: int = 0  # Already in the checkpoint
+    started: float = field(default_factory=time.monotonic)
+
+    def videos_per_hour(self):
+        elapsed = time.monotonic() - self.started
+        return (self.done + self.failed) / elapsed * 3600 if elapsed else 0.0
+
+    def to_dict(self):
+        return {
+            "total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "seconds": round(time.monotonic() - self.started, 1),
+            "videos_per_hour": round(self.videos_per_hour(), 1),
+        }
+
+
+async def process_one(path, executor, options, api_key, model, llm_slots):
+    """The output record of one video; failures are recorded, not raised."""
+    stat = os.stat(path)
+    record = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime}
+    try:
+        start = time.perf_counter()
+        keyframes, stats = await asyncio.get_running_loop().run_in_executor(
+            executor, process_video_with_stats, path, options)
+        record["decode_seconds"] = round(time.perf_counter() - start, 3)
+
+        start = time.perf_counter()
+        async with llm_slots:
+            output, complete = await analyze_video_windowed(keyframes, api_key, model)
+        record["analysis_seconds"] = round(time.perf_counter() - start, 3)
+
+        record.update({
+            "status": "done",
+            "steps": parse_steps(output),
+            "complete": complete,
+            "frame_indices": [keyframe.frame_index for keyframe in keyframes],
+            "duplicate_of": [keyframe.duplicate_of for keyframe in keyframes],
+            "frames_scanned": stats.frames_scanned,
+            "frames_changed": stats.frames_changed,
+            "frames_suppressed": stats.frames_suppressed,
+        })
+    except Exception as e:
+        record.update({"status": "failed", "error": f"{type(e).__name__}: {e}"})
+    return record
+
+
+async def run_batch(videos, output, api_key, model, options=None, workers=None, concurrency=4,
+                    retry_failed=False):
+    """
+    Process videos into the output JSONL and return the BatchStats.
+    At most workers + concurrency videos are in flight at once, so
+    keyframes waiting for the LLM never pile up in memory.
+    """
+    options = options or VideoOptions()
+    workers = workers or os.cpu_count() or 1
+    checkpoint = load_checkpoint(output)
+    stats = BatchStats()
+    pending = []
+    for path in videos:
+        record = checkpoint.get(path)
+        if record and (record["status"] == "done" or not retry_failed):
+            stats.skipped += 1
+        else:
+            pending.append(path)
+    stats.total = len(pending)
+
+    in_flight = asyncio.Semaphore(workers + concurrency)
+    llm_slots = asyncio.Semaphore(concurrency)
+    last_report = time.monotonic()
+
+    async def run(path, executor, out):
+        nonlocal last_report
+        async with in_flight:
+            record = await process_one(path, executor, options, api_key, model, llm_slots)
+        out.write(json.dumps(record) + "\n")
+        out.flush()
+        if record["status"] == "done":
+            stats.done += 1
+        else:
+            stats.failed += 1
+            print(f"{path}: {record['error']}", file=sys.stderr)
+        if time.monotonic() - last_report >= REPORT_INTERVAL:
+            last_report = time.monotonic()
+            print(json.dumps(stats.to_dict()), file=sys.stderr)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor, open(output, "a") as out:
+        try:
+            await asyncio.gather(*[run(path, executor, out) for path in pending])
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            await llm_client.async_clients.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="Directory of recordings or manifest file")
+    parser.add_argument("--output", required=True, help="JSONL file results are appended to")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"))
+    parser.add_argument("--workers", type=int, default=None, help="Decoding processes, one per CPU by default")
+    parser.add_argument("--concurrency", type=int, default=4, help="Videos analyzed by the LLM at once")
+    parser.add_argument("--sample-rate", type=float, default=None, help="VideoOptions.sample_rate")
+    parser.add_argument("--retry-failed", action="store_true", help="Process videos that failed in a previous run")
+    args = parser.parse_args()
+    if not args.api_key:
+        parser.error("--api-key or OPENAI_API_KEY is required")
+
+    options = VideoOptions()
+    if args.sample_rate:
+        options.sample_rate = args.sample_rate
+    videos = find_videos(args.source)
+    stats = asyncio.run(run_batch(videos, args.output, args.api_key, args.model, options, args.workers,
+                                  args.concurrency, args.retry_failed))
+    print(json.dumps(stats.to_dict()), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
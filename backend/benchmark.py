@@ -0,0 +1,247 @@
+"""
+Benchmark of the video pipeline on deterministic synthetic screen recordings.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --resolutions 1920x1080 --seconds 300 --densities 20 --workers 4
+
+For every recording it reports frames/sec, decode, detect and encode time,
+frames scanned, peak RSS, keyframe count and payload bytes of
+process_video, then drives the /video-to-frames/ and
+/video-to-frames/stream endpoints end-to-end against stub_openai.
+Results are written as JSON to compare runs across commits.
+"""
+import argparse
+import contextlib
+import dataclasses
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+
+@dataclasses.dataclass
+class Recording:
+    width: int
+    height: int
+    seconds: float
+    changes_per_minute: float  # Screen changes (menus, page switches, typing)
+    fps: int = 30
+    seed: int = 0
+
+    @property
+    def name(self):
+        return f"{self.width}x{self.height}-{self.seconds:g}s-{self.changes_per_minute:g}cpm-{self.fps}fps"
+
+
+def draw_screen(rng, width, height):
+    """A random application window: title bar, sidebar, buttons and text lines."""
+    screen = np.full((height, width, 3), 245, np.uint8)
+    cv2.rectangle(screen, (0, 0), (width, height // 18), (60, 60, 60), -1)
+    cv2.rectangle(screen, (0, height // 18), (width // 6, height), (225, 225, 230), -1)
+    for _ in range(rng.integers(4, 10)):
+        x, y = int(rng.integers(width // 5, width * 4 // 5)), int(rng.integers(height // 8, height * 7 // 8))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        cv2.rectangle(screen, (x, y), (x + width // 12, y + height // 24), color, -1)
+    scale = height / 1080
+    for line in range(rng.integers(5, 15)):
+        y = int(height // 8 + line * 45 * scale)
+        cv2.putText(screen, "".join(chr(c) for c in rng.integers(97, 123, 30)), (width // 5, y),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.8 * scale, (30, 30, 30), max(1, round(2 * scale)))
+    return screen
+
+
+def make_recording(recording, path):
+    """Write a synthetic screen recording; the same Recording always gives the same video."""
+    rng = np.random.default_rng(recording.seed)
+    frame_count = int(recording.seconds * recording.fps)
+    change_count = int(recording.seconds / 60 * recording.changes_per_minute)
+    change_frames = set(rng.choice(np.arange(1, frame_count), size=min(change_count, frame_count - 1),
+                                   replace=False).tolist())
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), recording.fps,
+                             (recording.width, recording.height))
+    screen = draw_screen(rng, recording.width, recording.height)
+    for index in range(frame_count):
+        if index in change_frames:
+            screen = draw_screen(rng, recording.width, recording.height)
+        frame = screen.copy()
+        # A moving cursor and a blinking caret, the usual screen recording noise
+        cursor = (int(recording.width / 2 + recording.width / 3 * np.sin(index / 40)),
+                  int(recording.height / 2 + recording.height / 3 * np.cos(index / 55)))
+        cv2.circle(frame, cursor, max(3, recording.height // 150), (0, 0, 0), -1)
+        if (index // (recording.fps // 2)) % 2:
+            cv2.line(frame, (recording.width // 5, recording.height // 10),
+                     (recording.width // 5, recording.height // 10 + recording.height // 40), (0, 0, 0), 2)
+        writer.write(frame)
+    writer.release()
+    return frame_count
+
+
+def measure_process_video(video_path, options):
+    """Run in a fresh process, so that peak RSS belongs to this recording only."""
+    from utils import frames_payload, process_video_with_stats
+
+    start = time.perf_counter()
+    # Keep stdout clean for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        keyframes, stats = process_video_with_stats(video_path, options)
+    total = time.perf_counter() - start
+    payload = frames_payload(keyframes)
+    return {
+        "seconds": round(total, 3),
+        # Summed over the segments with workers > 1, so they can add up to more than seconds
+        "stages": {
+            "decode": round(stats.decode_seconds, 3),
+            "detect": round(stats.detect_seconds, 3),
+            "encode": round(stats.encode_seconds, 3),
+        },
+        "keyframes": len(keyframes),
+        "duplicates": stats.duplicates,
+        "frames_scanned": stats.frames_scanned,
+        "frames_changed": stats.frames_changed,
+        "frames_suppressed": stats.frames_suppressed,
+        "encoded_bytes": stats.encoded_bytes,
+        "payload_bytes": len(json.dumps(payload)),
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                             / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+    }
+
+
+def measure_endpoints(client, video_path, model):
+    """Time the blocking and the streaming endpoint on the same video."""
+    def upload():
+        return {"file": ("recording.mp4", open(video_path, "rb"), "video/mp4")}
+
+    form = {"api_key": "benchmark", "model": model}
+    start = time.perf_counter()
+    response = client.post("/video-to-frames/", files=upload(), data=form)
+    response.raise_for_status()
+    blocking = time.perf_counter() - start
+
+    start = time.perf_counter()
+    first_keyframe = None
+    with client.stream("POST", "/video-to-frames/stream", files=upload(), data=form) as stream:
+        for line in stream.iter_lines():
+            event = json.loads(line)
+            if event["type"] == "keyframe" and first_keyframe is None:
+                first_keyframe = time.perf_counter() - start
+            if event["type"] == "error":
+                raise RuntimeError(event["detail"])
+    streamed = time.perf_counter() - start
+
+    return {
+        "blocking_seconds": round(blocking, 3),
+        "response_bytes": len(response.content),
+        "stream_seconds": round(streamed, 3),
+        "stream_first_keyframe_seconds": round(first_keyframe, 3) if first_keyframe is not None else None,
+    }
+
+
+def run_recording(recording, work_dir, options, client, model, mp_context):
+    video_path = os.path.join(work_dir, f"{recording.name}.mp4")
+    frame_count = make_recording(recording, video_path)
+    print(f"{recording.name}: {frame_count} frames", file=sys.stderr)
+    try:
+        with ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as executor:
+            pipeline = executor.submit(measure_process_video, video_path, options).result()
+        pipeline["frames_per_second"] = round(frame_count / pipeline["seconds"], 1)
+
+        result = {"recording": dataclasses.asdict(recording), "frames": frame_count, "process_video": pipeline}
+        if client:
+            result["endpoint"] = measure_endpoints(client, video_path, model)
+        return result
+    finally:
+        os.remove(video_path)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def parse_resolution(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resolutions", default="1280x720,1920x1080")
+    parser.add_argument("--seconds", default="30,120", help="Recording lengths")
+    parser.add_argument("--densities", default="4,30", help="Screen changes per minute")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--workers", type=int, default=1, help="VideoOptions.workers")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds the stub LLM waits per call")
+    parser.add_argument("--skip-endpoint", action="store_true")
+    parser.add_argument("--output", help="JSON file to write, stdout when omitted")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="video-benchmark-")
+    # Keep the server's cache and frame store directories out of the way
+    os.environ["CACHE_DIR"] = os.path.join(work_dir, "cache")
+    os.environ["FRAME_STORE_DIR"] = os.path.join(work_dir, "frames")
+
+    from utils import VideoOptions
+    options = VideoOptions(workers=args.workers)
+
+    client = None
+    if not args.skip_endpoint:
+        import httpx
+        import llm_client
+        import stub_openai
+
+        _, stub_url = stub_openai.serve_in_background(stub_openai.create_app(latency=args.llm_latency))
+        llm_client.LLM_BASE_URL = f"{stub_url}/v1"
+        import server
+        # Measure the pipeline, not the caches: both endpoints see the same video
+        server.job_manager.keyframe_cache = server.job_manager.analysis_cache = None
+        # A real server rather than the TestClient, which buffers streamed responses
+        _, server_url = stub_openai.serve_in_background(server.app)
+        client = httpx.Client(base_url=server_url, timeout=None)
+
+    recordings = [Recording(width, height, float(seconds), float(density), args.fps)
+                  for width, height in map(parse_resolution, args.resolutions.split(","))
+                  for seconds in args.seconds.split(",")
+                  for density in args.densities.split(",")]
+
+    results = []
+    spawn = multiprocessing.get_context("spawn")
+    with contextlib.redirect_stdout(sys.stderr):
+        for recording in recordings:
+            results.append(run_recording(recording, work_dir, options, client, args.model, spawn))
+
+    if client:
+        client.close()
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "platform": {"python": platform.python_version(), "opencv": cv2.__version__,
+                     "machine": platform.machine(), "cpus": os.cpu_count()},
+        "options": dataclasses.asdict(options),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
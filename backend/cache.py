@@ -0,0 +1,153 @@
+import dataclasses
+import getpass
+import hashlib
+import json
+import os
+import pickle
+import stat
+import tempfile
+import threading
+from collections import OrderedDict
+
+from prompts import analyze_video_prompt, analyze_video_schema
+
+
+def user_temp_dir(name):
+    """A directory of the shared temp directory named after the user running the server."""
+    user = os.getuid() if hasattr(os, "getuid") else getpass.getuser()
+    return os.path.join(tempfile.gettempdir(), f"{name}-{user}")
+
+
+# Cached values are unpickled, so the default directory is private to the user running the server
+CACHE_DIR = os.environ.get("CACHE_DIR") or user_temp_dir("video-to-frames-cache")
+CACHE_MEMORY_BYTES = int(os.environ.get("CACHE_MEMORY_MB", "256")) * 1024 * 1024
+CACHE_DISK_BYTES = int(os.environ.get("CACHE_DISK_MB", "2048")) * 1024 * 1024
+
+# Changing the prompt or the schema invalidates every cached analysis
+PROMPT_VERSION = hashlib.sha256(
+    (analyze_video_prompt + json.dumps(analyze_video_schema, sort_keys=True)).encode()).hexdigest()[:16]
+
+# VideoOptions fields that change how fast keyframes are found, not which ones
+NON_KEY_OPTIONS = {"workers", "min_segment_seconds", "save_dir", "frame_store"}
+
+
+def keyframes_key(video_hash, options):
+    params = {field.name: getattr(options, field.name) for field in dataclasses.fields(options)
+              if field.name not in NON_KEY_OPTIONS}
+    return hashlib.sha256(f"{video_hash}:{json.dumps(params, sort_keys=True)}".encode()).hexdigest()
+
+
+def analysis_key(keyframes, model):
+    digest = hashlib.sha256(f"{model}:{PROMPT_VERSION}".encode())
+    for keyframe in keyframes:
+        # Spooled keyframes are already named after the hash of their image
+        digest.update(keyframe.frame_id.encode() if keyframe.frame_id else hashlib.sha256(keyframe.data).digest())
+        digest.update(str(keyframe.duplicate_of).encode())
+    return digest.hexdigest()
+
+
+def private_directory(path):
+    """
+    Create path readable by this user only, or check that an existing one
+    cannot be written by anyone else: whoever can write to it can make the
+    cache unpickle their code, or replace stored frames.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if os.name != "posix":
+        return
+    info = os.stat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f"{path} must be a directory owned by this user and only writable by it")
+
+
+class ResultCache:
+    """
+    Two-level cache of picklable values: an in-memory LRU in front of files
+    on disk. Both levels are bounded in bytes and evict least recently used
+    entries first. Safe to use from several threads.
+    """
+
+    def __init__(self, name, directory=CACHE_DIR, memory_bytes=CACHE_MEMORY_BYTES, disk_bytes=CACHE_DISK_BYTES):
+        self.name = name
+        self.directory = os.path.join(directory, name)
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()  # key -> pickled value
+        self.memory_size = 0
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        self.lock = threading.Lock()
+        private_directory(directory)
+        private_directory(self.directory)
+        self.disk_size = sum(entry.stat().st_size for entry in os.scandir(self.directory))
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pkl")
+
+    def get(self, key):
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return pickle.loads(data)
+
+            path = self._path(key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                # The file modification time doubles as the disk LRU clock
+                os.utime(path)
+            except FileNotFoundError:
+                self.counters["misses"] += 1
+                return None
+
+            self.counters["disk_hits"] += 1
+            self._remember(key, data)
+            return pickle.loads(data)
+
+    def put(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            path = self._path(key)
+            if not os.path.exists(path):
+                with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as f:
+                    f.write(data)
+                os.replace(f.name, path)
+                self.disk_size += len(data)
+                self._evict_disk()
+            self._remember(key, data)
+
+    def _remember(self, key, data):
+        if key in self.memory:
+            self.memory_size -= len(self.memory.pop(key))
+        if len(data) > self.memory_bytes:
+            return
+        self.memory[key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+
+    def _evict_disk(self):
+        if self.disk_size <= self.disk_bytes:
+            return
+        entries = sorted(os.scandir(self.directory), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.disk_size <= self.disk_bytes:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self.disk_size -= size
+            self.counters["evictions"] += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counters,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_size,
+                "disk_bytes": self.disk_size,
+            }
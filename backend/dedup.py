@@ -0,0 +1,60 @@
+import cv2
+import numpy as np
+
+# What to do with a keyframe whose screen was already captured earlier in the video
+KEEP_POLICIES = (
+    "all",  # Keep it as is
+    "first",  # Drop it, only the first capture of a screen is kept
+    "revisit",  # Keep it without its image, as a reference to the first capture
+)
+
+
+def dhash(gray, size=8):
+    """
+    Difference hash of a grayscale image as a size*size bit integer: each
+    bit tells whether a pixel of the downscaled image is brighter than its
+    right neighbour.
+    """
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def popcount(values):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    # NumPy < 2.0
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class KeyframeIndex:
+    """
+    Perceptual hashes of every keyframe kept so far, looked up by Hamming
+    distance in one vectorized pass over the whole video.
+    """
+
+    def __init__(self, max_distance=4):
+        self.max_distance = max_distance
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.positions = []  # Keyframe position of every hash
+
+    def find(self, value, confirm=None):
+        """
+        Position of the closest keyframe within max_distance bits, or None.
+        An 8x8 dHash cannot tell apart screens sharing a layout, so
+        confirm(position), when given, is asked to check each match, the
+        closest first.
+        """
+        if not len(self.hashes):
+            return None
+        distances = popcount(self.hashes ^ np.uint64(value))
+        for closest in np.argsort(distances, kind="stable"):
+            if distances[closest] > self.max_distance:
+                break
+            if confirm is None or confirm(self.positions[closest]):
+                return self.positions[closest]
+        return None
+
+    def add(self, value, position):
+        self.hashes = np.append(self.hashes, np.uint64(value))
+        self.positions.append(position)
@@ -0,0 +1,54 @@
+"""
+Text description of a parsed screen for locate_element_prompt: one
+"id|x|y|w|h|content" line per element instead of the repr of the coords
+dict and content_list, optionally limited to the elements most relevant
+to the step.
+"""
+import os
+import re
+from typing import List, Tuple
+
+from parser_client import ParsedScreen
+
+# Elements listed per step, the most relevant first; 0 lists them all
+ELEMENT_LIMIT = int(os.environ.get("ELEMENT_LIMIT", "0"))
+
+WORD = re.compile(r"[a-z0-9]+")
+# OmniParser prefixes every entry with "Text Box ID 3: " or "Icon Box ID 3: ", the table has its own id column
+CONTENT_PREFIX = re.compile(r"^\s*(text|icon)\s+box\s+id\s+\d+\s*:\s*", re.IGNORECASE)
+
+
+def element_rows(parsed: ParsedScreen) -> List[list]:
+    """[id, x, y, w, h, content] of every element, in id order."""
+    rows = []
+    for element_id, box in parsed.coords.items():
+        content = ""
+        if element_id.isdigit() and int(element_id) < len(parsed.content_list):
+            content = CONTENT_PREFIX.sub("", str(parsed.content_list[int(element_id)] or ""))
+        # The table is one line per element and "|"-separated
+        content = " ".join(content.replace("|", "/").split())
+        rows.append([element_id, *(round(v) for v in box), content])
+    return sorted(rows, key=lambda row: (not row[0].isdigit(), int(row[0]) if row[0].isdigit() else row[0]))
+
+
+def relevance(content: str, words: set) -> float:
+    """Share of an element's words found in the step description."""
+    content_words = set(WORD.findall(content.lower()))
+    return len(content_words & words) / len(content_words) if content_words else 0.0
+
+
+def element_table(parsed: ParsedScreen, step_text: str, limit: int = ELEMENT_LIMIT) -> Tuple[str, int]:
+    """
+    The element table of a parsed screen and the number of elements it
+    lists. With a limit, only the 'limit' elements sharing most words
+    with step_text are listed, in id order; the screenshot still shows
+    all of them.
+    """
+    rows = element_rows(parsed)
+    kept = rows
+    if limit and len(rows) > limit:
+        words = set(WORD.findall(step_text.lower()))
+        ranked = sorted(range(len(rows)), key=lambda i: -relevance(rows[i][5], words))
+        kept = [rows[i] for i in sorted(ranked[:limit])]
+    lines = ["id|x|y|w|h|content"] + ["|".join(str(v) for v in row) for row in kept]
+    return "\n".join(lines), len(kept)
@@ -0,0 +1,103 @@
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+from cache import private_directory, user_temp_dir
+
+# Frames are read back and sent to the LLM, and evict() removes whatever is in the directory
+FRAME_STORE_DIR = os.environ.get("FRAME_STORE_DIR") or user_temp_dir("video-to-frames-frames")
+FRAME_STORE_BYTES = int(os.environ.get("FRAME_STORE_MB", "2048")) * 1024 * 1024
+# Frames not written or used for this long are removed, in seconds
+FRAME_TTL = int(os.environ.get("FRAME_TTL", "3600"))
+# Time between two eviction passes, in seconds
+EVICT_INTERVAL = 60
+
+MIME_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".webp": "image/webp"}
+FRAME_ID = re.compile(r"^[0-9a-f]{64}\.(png|jpg|webp)$")
+
+
+def frame_url(frame_id):
+    return f"/frames/{frame_id}"
+
+
+class FrameStore:
+    """
+    Encoded keyframes on local disk, named after the SHA-256 of their
+    content, so identical frames are stored once. Entries expire FRAME_TTL
+    seconds after they were last written or used, and the oldest go first
+    when the store is over its size. Nothing but the settings is kept in
+    memory, so a store can be handed to pool processes and written there.
+    """
+
+    def __init__(self, directory=FRAME_STORE_DIR, max_bytes=FRAME_STORE_BYTES, ttl=FRAME_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        private_directory(directory)
+
+    def path(self, frame_id):
+        """Path of a stored frame, or None for unknown or malformed ids."""
+        if not FRAME_ID.match(frame_id):
+            return None
+        path = os.path.join(self.directory, frame_id)
+        return path if os.path.exists(path) else None
+
+    def put(self, data, extension):
+        """Store encoded image bytes; returns the frame id."""
+        frame_id = hashlib.sha256(data).hexdigest() + extension
+        path = os.path.join(self.directory, frame_id)
+        if os.path.exists(path):
+            self.touch([frame_id])
+            return frame_id
+        with tempfile.NamedTemporaryFile(dir=self.directory, prefix=".", delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+        return frame_id
+
+    def read(self, frame_id):
+        with open(os.path.join(self.directory, frame_id), "rb") as f:
+            return f.read()
+
+    def touch(self, frame_ids):
+        """Restart the TTL of frames still in use. Returns False if one of them is gone."""
+        try:
+            for frame_id in frame_ids:
+                os.utime(os.path.join(self.directory, frame_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def evict(self):
+        """Remove expired frames, then the least recently used ones until the store fits in max_bytes."""
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if now - mtime <= self.ttl and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        count = size = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith("."):
+                continue
+            try:
+                size += entry.stat().st_size
+            except FileNotFoundError:
+                continue
+            count += 1
+        return {"frames": count, "bytes": size}
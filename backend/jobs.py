@@ -0,0 +1,379 @@
+import asyncio
+import multiprocessing
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional
+
+import metrics
+from cache import ResultCache, analysis_key, keyframes_key
+from frame_store import frame_url
+from utils import (WINDOW_OVERLAP, WINDOW_TOKEN_BUDGET, VideoOptions, analyze_video_stream, analyze_video_windowed,
+                   frames_payload, iter_process_video, process_video_with_stats, remove_file, split_windows)
+
+# Number of processes decoding videos in parallel
+VIDEO_WORKERS = int(os.environ.get("VIDEO_WORKERS", os.cpu_count() or 1))
+# Maximum number of unfinished jobs before new submissions are rejected
+MAX_PENDING_JOBS = int(os.environ.get("MAX_PENDING_JOBS", "16"))
+# How long finished jobs (and their results) are kept around, in seconds
+JOB_TTL = int(os.environ.get("JOB_TTL", "3600"))
+
+# Minimum time between two progress events of a streamed job, in seconds
+PROGRESS_INTERVAL = 0.25
+
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+SPAWN = multiprocessing.get_context("spawn")
+
+
+class QueueFullError(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    id: str
+    status: str = "processing"  # processing -> analyzing -> done | failed | cancelled
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    error_status: int = 500
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+
+def scan_into_queue(video_path, options, queue, stop):
+    """
+    Pool side of a streamed job: put the events of iter_process_video on
+    queue until the video is scanned or stop is set, then remove the video.
+    """
+    try:
+        for item in iter_process_video(video_path, options):
+            if stop.is_set():
+                break
+            queue.put(item)
+    finally:
+        remove_file(video_path)
+
+
+def keyframe_event(index, keyframe):
+    return {
+        "type": "keyframe",
+        "index": index,
+        "frame_index": keyframe.frame_index,
+        # Spooled keyframes are fetched from their URL instead
+        "frame": None if keyframe.frame_id else keyframe.base64(),
+        "frame_id": keyframe.frame_id,
+        "url": frame_url(keyframe.frame_id) if keyframe.frame_id else None,
+        "frame_type": keyframe.mime_type,
+        "duplicate_of": keyframe.duplicate_of,
+        "bytes": keyframe.size,
+        "encode_ms": round(keyframe.encode_time * 1000, 2),
+    }
+
+
+def error_status(job, e):
+    """HTTP status of a failed job."""
+    if job.status == "analyzing":
+        # The LLM call failed or answered something unusable, not the client's fault
+        return 502
+    # process_video raises ValueError for videos it cannot read
+    return 400 if isinstance(e, ValueError) else 500
+
+
+class JobManager:
+    """
+    Runs video jobs off the event loop: decoding happens in a process pool,
+    the LLM call on async I/O. Submissions beyond max_pending are rejected.
+    """
+
+    def __init__(self, workers: int = VIDEO_WORKERS, max_pending: int = MAX_PENDING_JOBS,
+                 keyframe_cache: Optional[ResultCache] = None, analysis_cache: Optional[ResultCache] = None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.keyframe_cache = keyframe_cache
+        self.analysis_cache = analysis_cache
+        self.jobs: dict[str, Job] = {}
+        # Videos of streamed jobs not yet removed or handed to their decoding thread, by job id
+        self.unclaimed: dict[str, str] = {}
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._manager = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # Forked workers would inherit the sockets of the requests being served, and keep
+            # connections of clients that went away open
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=SPAWN)
+        return self._executor
+
+    @property
+    def manager(self):
+        """Serves the queues relaying the events of streamed jobs from the pool."""
+        if self._manager is None:
+            self._manager = SPAWN.Manager()
+        return self._manager
+
+    def shutdown(self):
+        for job in self.jobs.values():
+            if job.task and not job.task.done():
+                job.task.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+    def pending_count(self) -> int:
+        return sum(1 for job in self.jobs.values() if not job.finished)
+
+    def submit(self, video_path: str, api_key: str, model: str, options: Optional[VideoOptions] = None,
+               video_hash: Optional[str] = None) -> Job:
+        """
+        Start a job for an uploaded video. The job takes ownership of
+        video_path and removes it once decoding is over. video_hash, the
+        SHA-256 of the video, enables the keyframe cache.
+        """
+        job = self._new_job(video_path)
+        job.task = asyncio.create_task(self._run(job, video_path, api_key, model, options or VideoOptions(), video_hash))
+        return job
+
+    def stream(self, video_path: str, api_key: str, model: str, options: Optional[VideoOptions] = None,
+               video_hash: Optional[str] = None) -> tuple[Job, AsyncIterator[dict]]:
+        """
+        Like submit, but returns the job with an async iterator of its
+        events: progress and keyframes as soon as they are found, then the
+        analysis as the completion streams in. Decoding runs in the pool
+        like submit's, its events are relayed back one by one. The caller must pass the events to close_stream once
+        done with them, iterated or not.
+        """
+        job = self._new_job(video_path)
+        self.unclaimed[job.id] = video_path
+        return job, self._stream(job, video_path, api_key, model, options or VideoOptions(), video_hash)
+
+    async def close_stream(self, job: Job, events: AsyncIterator[dict]):
+        """
+        Close the events of a streamed job. A job closed before decoding
+        started (the client went away first) is cancelled and its video removed.
+        """
+        await events.aclose()
+        video_path = self.unclaimed.pop(job.id, None)
+        if video_path:
+            remove_file(video_path)
+        self._finish(job, "cancelled")
+
+    def _new_job(self, video_path: str) -> Job:
+        self._prune()
+        if self.pending_count() >= self.max_pending:
+            remove_file(video_path)
+            raise QueueFullError("Too many videos are being processed, try again later")
+
+        job = Job(id=uuid.uuid4().hex)
+        self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def forget(self, job_id: str):
+        self.jobs.pop(job_id, None)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        job = self.jobs.get(job_id)
+        if job and not job.finished:
+            # A decode that already started in a worker runs to completion,
+            # but its result is discarded. Streamed jobs notice the status
+            # change at their next event.
+            if job.task:
+                job.task.cancel()
+            self._finish(job, "cancelled")
+        return job
+
+    async def _run(self, job: Job, video_path: str, api_key: str, model: str, options: VideoOptions,
+                   video_hash: Optional[str]):
+        try:
+            try:
+                keyframes, keyframes_cached = await self._keyframes(video_path, options, video_hash)
+            finally:
+                remove_file(video_path)
+
+            job.status = "analyzing"
+            output, output_cached = await self._analysis(keyframes, api_key, model)
+            job.result = {
+                **frames_payload(keyframes),
+                "output": output,
+                "cached": {"keyframes": keyframes_cached, "analysis": output_cached},
+            }
+            self._finish(job, "done")
+        except asyncio.CancelledError:
+            self._finish(job, "cancelled")
+            raise
+        except Exception as e:
+            job.error = str(e)
+            job.error_status = error_status(job, e)
+            self._finish(job, "failed")
+
+    async def _stream(self, job: Job, video_path: str, api_key: str, model: str, options: VideoOptions,
+                      video_hash: Optional[str]):
+        try:
+            key = keyframes_key(video_hash, options) if video_hash and self.keyframe_cache else None
+            keyframes = await asyncio.to_thread(self._cached_keyframes, key) if key else None
+            keyframes_cached = keyframes is not None
+
+            if keyframes_cached:
+                self.unclaimed.pop(job.id, None)
+                remove_file(video_path)
+                for index, keyframe in enumerate(keyframes):
+                    yield keyframe_event(index, keyframe)
+            else:
+                keyframes = []
+                last_progress = 0
+                events = self._pooled_events(video_path, options)
+                self.unclaimed.pop(job.id, None)
+                try:
+                    async for event, value in events:
+                        if job.finished:
+                            return
+                        if event == "keyframe":
+                            keyframes.append(value)
+                            yield keyframe_event(len(keyframes) - 1, value)
+                        elif event == "stats":
+                            metrics.record_scan(value)
+                        elif time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                            last_progress = time.monotonic()
+                            scanned, total = value
+                            yield {"type": "progress", "scanned": scanned, "total": total}
+                finally:
+                    # Async generators left early are only closed when garbage collected, stop decoding now
+                    await events.aclose()
+                if key:
+                    await asyncio.to_thread(self.keyframe_cache.put, key, keyframes)
+
+            job.status = "analyzing"
+            yield {"type": "analyzing", "keyframes": len(keyframes)}
+
+            key = analysis_key(keyframes, model) if self.analysis_cache else None
+            output = await asyncio.to_thread(self.analysis_cache.get, key) if key else None
+            output_cached = output is not None
+            if not output_cached and len(split_windows(keyframes, WINDOW_TOKEN_BUDGET, WINDOW_OVERLAP)) > 1:
+                # Windows are analyzed concurrently and merged, there is nothing to stream
+                output, complete = await analyze_video_windowed(keyframes, api_key, model)
+                yield {"type": "analysis", "delta": output}
+            elif not output_cached:
+                parts = []
+                finish_reason = None
+                async for delta, finish_reason in analyze_video_stream(keyframes, api_key, model):
+                    if job.finished:
+                        return
+                    if delta:
+                        parts.append(delta)
+                        yield {"type": "analysis", "delta": delta}
+                output = "".join(parts)
+                complete = finish_reason == "stop"
+            # Truncated answers are not worth keeping
+            if key and not output_cached and complete:
+                await asyncio.to_thread(self.analysis_cache.put, key, output)
+
+            payload = frames_payload(keyframes)
+            job.result = {
+                **payload,
+                "output": output,
+                "cached": {"keyframes": keyframes_cached, "analysis": output_cached},
+            }
+            self._finish(job, "done")
+            timings = metrics.request_timings.get()
+            yield {"type": "done", "output": output, "encoding": payload["encoding"], "cached": job.result["cached"],
+                   "timings_ms": timings.to_dict() if timings else {}}
+        except Exception as e:
+            job.error = str(e)
+            job.error_status = error_status(job, e)
+            self._finish(job, "failed")
+            yield {"type": "error", "status": job.error_status, "detail": job.error}
+        finally:
+            # The consumer went away before the job finished
+            self._finish(job, "cancelled")
+
+    async def _pooled_events(self, video_path: str, options: VideoOptions):
+        """The events of iter_process_video run in the pool, which takes ownership of video_path."""
+        queue, stop = self.manager.Queue(), self.manager.Event()
+        future = self.executor.submit(scan_into_queue, video_path, options, queue, stop)
+        # Also called for a failed or cancelled scan, so the relay below always ends
+        future.add_done_callback(lambda f: queue.put(("end", None if f.cancelled() else f.exception())))
+        try:
+            while True:
+                event, value = await asyncio.to_thread(queue.get)
+                if event == "end":
+                    if value:
+                        raise value
+                    return
+                yield event, value
+        finally:
+            stop.set()
+            if future.cancel():
+                # Still waiting for a worker, nobody else will remove the video
+                remove_file(video_path)
+
+    async def _keyframes(self, video_path: str, options: VideoOptions, video_hash: Optional[str]):
+        key = keyframes_key(video_hash, options) if video_hash and self.keyframe_cache else None
+        if key:
+            keyframes = await asyncio.to_thread(self._cached_keyframes, key)
+            if keyframes is not None:
+                return keyframes, True
+
+        loop = asyncio.get_running_loop()
+        keyframes, stats = await loop.run_in_executor(self.executor, process_video_with_stats, video_path, options)
+        metrics.record_scan(stats)
+        if key:
+            await asyncio.to_thread(self.keyframe_cache.put, key, keyframes)
+        return keyframes, False
+
+    def _cached_keyframes(self, key: str):
+        keyframes = self.keyframe_cache.get(key)
+        if keyframes is None:
+            return None
+        # The frame store may have evicted images the cached keyframes refer to
+        spooled = [keyframe for keyframe in keyframes if keyframe.frame_id]
+        if spooled and not spooled[0].store.touch([keyframe.frame_id for keyframe in spooled]):
+            return None
+        return keyframes
+
+    async def _analysis(self, keyframes, api_key: str, model: str):
+        key = analysis_key(keyframes, model) if self.analysis_cache else None
+        if key:
+            output = await asyncio.to_thread(self.analysis_cache.get, key)
+            if output is not None:
+                return output, True
+
+        output, complete = await analyze_video_windowed(keyframes, api_key, model)
+        # Truncated answers are not worth keeping
+        if key and complete:
+            await asyncio.to_thread(self.analysis_cache.put, key, output)
+        return output, False
+
+    def _finish(self, job: Job, status: str):
+        if not job.finished:
+            job.status = status
+            job.finished_at = time.time()
+
+    def _prune(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished and now - job.finished_at > JOB_TTL]
+        for job_id in expired:
+            del self.jobs[job_id]
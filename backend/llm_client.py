@@ -0,0 +1,229 @@
+import asyncio
+import os
+import random
+import time
+import weakref
+from collections import deque
+
+import httpx
+import openai
+from openai import AsyncOpenAI, OpenAI
+
+import metrics
+
+# The OpenAI SDK also reads OPENAI_BASE_URL, set it to point at stub_openai.py
+LLM_BASE_URL = os.environ.get("OPENAI_BASE_URL") or None
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "120"))  # Seconds for a whole completion
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "10"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF = float(os.environ.get("LLM_BACKOFF", "0.5"))  # Base delay of the exponential backoff
+LLM_MAX_BACKOFF = float(os.environ.get("LLM_MAX_BACKOFF", "20"))
+LLM_CONCURRENCY_PER_KEY = int(os.environ.get("LLM_CONCURRENCY_PER_KEY", "8"))
+LLM_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_KEEPALIVE_CONNECTIONS", "20"))
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError,
+                    openai.APIConnectionError, openai.APITimeoutError)
+
+
+class LLMStats:
+    """Counters and recent call latencies of the LLM client layer."""
+
+    def __init__(self, recent=100):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency_total = 0.0
+        self.recent = deque(maxlen=recent)  # (model, seconds, prompt_tokens, completion_tokens)
+
+    def record(self, model, latency, usage=None):
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        metrics.record_stage("llm", latency)
+        metrics.registry.inc("llm_requests_total", outcome="ok")
+        metrics.registry.inc("llm_prompt_tokens_total", prompt_tokens)
+        metrics.registry.inc("llm_completion_tokens_total", completion_tokens)
+        self.calls += 1
+        self.latency_total += latency
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.recent.append((model, round(latency, 3), prompt_tokens, completion_tokens))
+
+    def error(self):
+        self.errors += 1
+        metrics.registry.inc("llm_requests_total", outcome="error")
+
+    def retry(self):
+        self.retries += 1
+        metrics.registry.inc("llm_requests_total", outcome="retry")
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "average_latency": round(self.latency_total / self.calls, 3) if self.calls else None,
+            "recent": [
+                {"model": model, "latency": latency, "prompt_tokens": prompt, "completion_tokens": completion}
+                for model, latency, prompt, completion in self.recent
+            ],
+        }
+
+
+stats = LLMStats()
+
+
+def timeout():
+    return httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+
+
+def limits():
+    return httpx.Limits(max_keepalive_connections=LLM_KEEPALIVE_CONNECTIONS, keepalive_expiry=60)
+
+
+def backoff_delay(attempt, error=None):
+    """Full-jitter exponential backoff, honouring a Retry-After header when there is one."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), LLM_MAX_BACKOFF)
+        except ValueError:
+            pass
+    return random.uniform(0, min(LLM_MAX_BACKOFF, LLM_BACKOFF * 2 ** attempt))
+
+
+class AsyncClientPool:
+    """
+    One keep-alive AsyncOpenAI client and one concurrency limit per API
+    key. httpx connections are bound to an event loop, so every loop gets
+    its own set of clients.
+    """
+
+    def __init__(self):
+        self._pools = weakref.WeakKeyDictionary()  # loop -> {api_key: (client, semaphore)}
+
+    def get(self, api_key):
+        pool = self._pools.setdefault(asyncio.get_running_loop(), {})
+        if api_key not in pool:
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=LLM_BASE_URL,
+                timeout=timeout(),
+                # Retries are done here, so they share the concurrency limit and show in the stats
+                max_retries=0,
+                http_client=httpx.AsyncClient(limits=limits(), timeout=timeout()),
+            )
+            pool[api_key] = (client, asyncio.Semaphore(LLM_CONCURRENCY_PER_KEY))
+        return pool[api_key]
+
+    async def close(self):
+        pool = self._pools.pop(asyncio.get_running_loop(), {})
+        for client, _ in pool.values():
+            await client.close()
+
+
+async_clients = AsyncClientPool()
+sync_clients = {}
+
+
+def get_sync_client(api_key):
+    if api_key not in sync_clients:
+        sync_clients[api_key] = OpenAI(
+            api_key=api_key,
+            base_url=LLM_BASE_URL,
+            timeout=timeout(),
+            max_retries=LLM_MAX_RETRIES,
+            http_client=httpx.Client(limits=limits(), timeout=timeout()),
+        )
+    return sync_clients[api_key]
+
+
+def request_bytes(request):
+    """Size of the message content of a chat completion request; images count as their data URL."""
+    size = 0
+    for message in request.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            size += len(content)
+            continue
+        for part in content or []:
+            size += len(part.get("text") or part.get("image_url", {}).get("url", ""))
+    return size
+
+
+def chat_completion(api_key, **request):
+    """Blocking chat completion on a pooled client; the SDK does the retries."""
+    metrics.registry.inc("llm_request_bytes_total", request_bytes(request))
+    start = time.perf_counter()
+    try:
+        response = get_sync_client(api_key).chat.completions.create(**request)
+    except Exception:
+        stats.error()
+        raise
+    stats.record(request.get("model"), time.perf_counter() - start, response.usage)
+    return response
+
+
+async def chat_completion_async(api_key, **request):
+    """Chat completion on a pooled async client, with bounded concurrency and jittered retries."""
+    metrics.registry.inc("llm_request_bytes_total", request_bytes(request))
+    client, semaphore = async_clients.get(api_key)
+    async with semaphore:
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            start = time.perf_counter()
+            try:
+                response = await client.chat.completions.create(**request)
+            except RETRYABLE_ERRORS as e:
+                if attempt == LLM_MAX_RETRIES:
+                    stats.error()
+                    raise
+                stats.retry()
+                await asyncio.sleep(backoff_delay(attempt, e))
+                continue
+            except Exception:
+                stats.error()
+                raise
+            stats.record(request.get("model"), time.perf_counter() - start, response.usage)
+            return response
+
+
+async def chat_completion_stream(api_key, **request):
+    """
+    Streamed chat completion, yielding the SDK chunks. Retries only
+    happen until the first chunk arrives, later failures are raised.
+    """
+    metrics.registry.inc("llm_request_bytes_total", request_bytes(request))
+    client, semaphore = async_clients.get(api_key)
+    async with semaphore:
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            start = time.perf_counter()
+            try:
+                stream = await client.chat.completions.create(
+                    **request, stream=True, stream_options={"include_usage": True})
+                break
+            except RETRYABLE_ERRORS as e:
+                if attempt == LLM_MAX_RETRIES:
+                    stats.error()
+                    raise
+                stats.retry()
+                await asyncio.sleep(backoff_delay(attempt, e))
+            except Exception:
+                stats.error()
+                raise
+
+        usage = None
+        try:
+            async for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                yield chunk
+        except Exception:
+            stats.error()
+            raise
+        finally:
+            await stream.close()
+        stats.record(request.get("model"), time.perf_counter() - start, usage)
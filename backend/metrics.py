@@ -0,0 +1,206 @@
+"""
+Counters, per-stage timings and an opt-in sampling profiler for the
+video pipeline.
+
+Metrics are rendered in the Prometheus text format by /metrics. Stage
+timings are also collected per request and sent back in a Server-Timing
+header.
+"""
+import contextvars
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional
+
+# Profile requests sent with an "X-Profile: 1" header; off by default since
+# every thread of the server is sampled while a profile is running
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS", "").lower() in ("1", "true", "yes")
+PROFILE_DIR = os.environ.get("PROFILE_DIR") or "profiles"
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL_MS", "5")) / 1000
+
+# Upper bounds of the stage duration histogram buckets, in seconds
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class Registry:
+    """Counters, gauges and histograms keyed by name and labels. Safe to use from several threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}  # name -> (type, help text)
+        self.values = {}  # (name, sorted label items) -> value
+        self.histograms = {}  # (name, sorted label items) -> [bucket counts, sum, count]
+        self.gauges = {}  # name -> function returning the current value
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [[0] * len(STAGE_BUCKETS), 0.0, 0])
+            for i, bound in enumerate(STAGE_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def gauge(self, name, text, function):
+        self.describe(name, "gauge", text)
+        self.gauges[name] = function
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: (list(buckets), total, count) for key, (buckets, total, count) in self.histograms.items()}
+        samples = {}  # name -> lines
+        for (name, labels), value in sorted(values.items()):
+            samples.setdefault(name, []).append(f"{name}{format_labels(dict(labels))} {value}")
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            lines = samples.setdefault(name, [])
+            for bound, bucket in zip(STAGE_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{format_labels({**dict(labels), 'le': bound})} {bucket}")
+            lines.append(f"{name}_bucket{format_labels({**dict(labels), 'le': '+Inf'})} {count}")
+            lines.append(f"{name}_sum{format_labels(dict(labels))} {total}")
+            lines.append(f"{name}_count{format_labels(dict(labels))} {count}")
+        for name, function in self.gauges.items():
+            samples[name] = [f"{name} {function()}"]
+
+        output = []
+        for name in sorted(set(samples) | set(self.help)):
+            kind, text = self.help.get(name, ("untyped", ""))
+            output.append(f"# HELP {name} {text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(samples.get(name, []))
+        return "\n".join(output) + "\n"
+
+
+registry = Registry()
+registry.describe("video_stage_seconds", "histogram",
+                  "Time spent per pipeline stage: upload_receive, decode, detect, encode, llm")
+registry.describe("http_request_seconds", "histogram", "HTTP request duration by route and status")
+registry.describe("video_upload_bytes_total", "counter", "Bytes of uploaded videos")
+registry.describe("video_frames_scanned_total", "counter", "Sampled frames compared for changes")
+registry.describe("video_frames_changed_total", "counter", "Sampled frames with a relevant change")
+registry.describe("video_frames_suppressed_total", "counter", "Sampled frames whose only change was masked noise")
+registry.describe("video_keyframes_total", "counter", "Keyframes kept, revisited screens included")
+registry.describe("video_duplicate_keyframes_total", "counter", "Keyframes of a screen seen earlier in the video")
+registry.describe("video_encoded_bytes_total", "counter", "Bytes of encoded keyframe images")
+registry.describe("llm_requests_total", "counter", "LLM calls by outcome: ok, retry or error")
+registry.describe("llm_request_bytes_total", "counter", "Bytes of message content sent to the LLM")
+registry.describe("llm_prompt_tokens_total", "counter", "Prompt tokens reported by the LLM")
+registry.describe("llm_completion_tokens_total", "counter", "Completion tokens reported by the LLM")
+
+
+class Timings:
+    """Stage durations of one request, for the Server-Timing header."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}  # stage -> seconds
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def to_dict(self):
+        return {stage: round(seconds * 1000, 1) for stage, seconds in self.stages.items()}
+
+    def header(self):
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items())
+
+
+# Timings of the request being served. Tasks started while handling it
+# (jobs included) inherit it, so their stages show up in its header.
+request_timings: contextvars.ContextVar[Optional[Timings]] = contextvars.ContextVar("request_timings", default=None)
+
+
+def record_stage(stage, seconds):
+    registry.observe("video_stage_seconds", seconds, stage=stage)
+    timings = request_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def record_scan(stats):
+    """Record the ScanStats of a video processed in this or another process."""
+    record_stage("decode", stats.decode_seconds)
+    record_stage("detect", stats.detect_seconds)
+    record_stage("encode", stats.encode_seconds)
+    registry.inc("video_frames_scanned_total", stats.frames_scanned)
+    registry.inc("video_frames_changed_total", stats.frames_changed)
+    registry.inc("video_frames_suppressed_total", stats.frames_suppressed)
+    registry.inc("video_keyframes_total", stats.keyframes)
+    registry.inc("video_duplicate_keyframes_total", stats.duplicates)
+    registry.inc("video_encoded_bytes_total", stats.encoded_bytes)
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread of this process at a fixed
+    interval and writes them in the collapsed format read by flamegraph.pl
+    and speedscope. Work done in pool processes is not seen.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                entries = []
+                while frame is not None:
+                    code = frame.f_code
+                    entries.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(entries))] += 1
+
+    def save(self, name):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{name}.collapsed")
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
@@ -0,0 +1,61 @@
+import math
+
+import cv2
+import numpy as np
+
+
+class NoiseMask:
+    """
+    Pixels of the reduced samples left out of change detection: the mask
+    rectangles given by the user (a clock, a notification area) and the
+    pixels learned to flicker (a blinking caret, a spinner).
+
+    Flicker is learned over the first learn_samples comparisons: a pixel
+    changing in min_changes of them is masked from then on. Comparisons
+    changing more than max_share of the pixels are screen transitions, not
+    noise, and are not counted.
+    """
+
+    def __init__(self, shape, scale, origin=(0, 0), regions=(), learn_samples=0, threshold=70, min_changes=3,
+                 max_share=0.02):
+        """
+        shape: shape of the reduced samples; scale: reduced pixels per
+        video pixel; origin: video coordinates of the sample's top left
+        corner; regions: (x, y, width, height) rectangles in video pixels.
+        """
+        self.keep = np.full(shape, 255, np.uint8)
+        for x, y, w, h in regions or ():
+            x0, y0 = max(0, int((x - origin[0]) * scale)), max(0, int((y - origin[1]) * scale))
+            x1, y1 = math.ceil((x + w - origin[0]) * scale), math.ceil((y + h - origin[1]) * scale)
+            if x1 > 0 and y1 > 0:
+                self.keep[y0:y1, x0:x1] = 0
+        # uint8 counts, a pixel changes at most once per comparison
+        self.learn_samples = min(learn_samples, 255)
+        self.counts = np.zeros(shape, np.uint8) if self.learn_samples else None
+        self.threshold = threshold
+        self.min_changes = min_changes
+        self.max_share = max_share
+        self.samples = 0
+
+    @property
+    def learning(self):
+        return self.counts is not None
+
+    @property
+    def masked_pixels(self):
+        return self.keep.size - cv2.countNonZero(self.keep)
+
+    def learn(self, prev_gray, gray):
+        """Count the pixels changed between two samples, and mask the ones that keep changing."""
+        self.samples += 1
+        diff = cv2.absdiff(prev_gray, gray)
+        _, changed = cv2.threshold(diff, self.threshold, 1, cv2.THRESH_BINARY)
+        if cv2.countNonZero(changed) <= self.max_share * changed.size:
+            self.counts += changed
+            flicker = cv2.compare(self.counts, self.min_changes, cv2.CMP_GE)
+            if cv2.countNonZero(flicker):
+                # Anti-aliased edges of what flickers flicker too
+                flicker = cv2.dilate(flicker, np.ones((3, 3), np.uint8))
+                self.keep[flicker > 0] = 0
+        if self.samples >= self.learn_samples:
+            self.counts = None
@@ -0,0 +1,123 @@
+"""
+Client of the screen parser service, which finds the UI elements of a
+screenshot and returns it annotated with their ids.
+
+Two protocols are supported:
+
+- "binary": the screenshot is uploaded as a multipart file to
+  POST /parse, which answers with the annotated image as the raw body and
+  the elements as JSON in the X-Parse-Result header
+- "json": the legacy POST /file endpoint, with both images base64 encoded
+  inside JSON
+
+stub_parser.py implements both for local runs.
+"""
+import ast
+import base64
+import json
+import os
+from dataclasses import dataclass
+from typing import Dict, List
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+PARSER_URL = os.environ.get("PARSER_URL", "http://79.117.18.84:38414")
+PARSER_PROTOCOL = os.environ.get("PARSER_PROTOCOL", "json")
+PARSER_TIMEOUT = float(os.environ.get("PARSER_TIMEOUT", "60"))  # Seconds to wait for a parse
+PARSER_CONNECT_TIMEOUT = float(os.environ.get("PARSER_CONNECT_TIMEOUT", "5"))
+PARSER_MAX_RETRIES = int(os.environ.get("PARSER_MAX_RETRIES", "3"))
+
+# Header of a binary protocol answer with its coords and content_list
+RESULT_HEADER = "X-Parse-Result"
+
+
+@dataclass
+class ParsedScreen:
+    image: bytes  # The screenshot annotated with element ids
+    media_type: str
+    coords: Dict[str, List[float]]  # Element id -> [x, y, width, height] in screenshot pixels
+    content_list: list  # Text or caption of every element
+
+
+def load_literal(text):
+    """
+    Decode a JSON value. The legacy endpoint formats some fields with
+    Python's repr, which literal_eval reads without executing anything.
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        return ast.literal_eval(text)
+
+
+def parse_coords(value) -> Dict[str, List[float]]:
+    """Element boxes from a parser response, which may send them as a JSON string."""
+    coords = load_literal(value) if isinstance(value, str) else value
+    if not isinstance(coords, dict):
+        raise ValueError("Parser coords are not an object")
+    for element_id, box in coords.items():
+        if not (isinstance(box, list) and len(box) == 4 and all(isinstance(v, (int, float)) for v in box)):
+            raise ValueError(f"Invalid box for element {element_id}: {box!r}")
+    return {str(element_id): box for element_id, box in coords.items()}
+
+
+class ParserClient:
+    """
+    Keep-alive session to the parser. Connection errors and 429/5xx
+    answers are retried with exponential backoff; parsing a screenshot
+    twice is harmless.
+    """
+
+    def __init__(self, base_url: str = PARSER_URL, protocol: str = PARSER_PROTOCOL,
+                 timeout: float = PARSER_TIMEOUT, retries: int = PARSER_MAX_RETRIES):
+        if protocol not in ("binary", "json"):
+            raise ValueError(f"Unknown parser protocol: {protocol}")
+        self.base_url = base_url.rstrip("/")
+        self.protocol = protocol
+        self.timeout = (PARSER_CONNECT_TIMEOUT, timeout)
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=None, raise_on_status=False)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=4)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def parse(self, image: bytes, media_type: str = "image/jpeg") -> ParsedScreen:
+        if self.protocol == "binary":
+            return self._parse_binary(image, media_type)
+        return self._parse_json(image)
+
+    def _parse_binary(self, image: bytes, media_type: str) -> ParsedScreen:
+        extension = media_type.split("/")[-1]
+        response = self.session.post(f"{self.base_url}/parse",
+                                     files={"image": (f"screen.{extension}", image, media_type)},
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        if RESULT_HEADER not in response.headers:
+            raise ValueError(f"Parser answer has no {RESULT_HEADER} header")
+        result = json.loads(response.headers[RESULT_HEADER])
+        return ParsedScreen(
+            image=response.content,
+            media_type=response.headers.get("content-type", "image/png").split(";")[0],
+            coords=parse_coords(result["coords"]),
+            content_list=result["content_list"],
+        )
+
+    def _parse_json(self, image: bytes) -> ParsedScreen:
+        response = self.session.post(f"{self.base_url}/file", json={"image": base64.b64encode(image).decode()},
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        result = response.json()
+        content_list = result.get("content_list")
+        return ParsedScreen(
+            image=base64.b64decode(result["photo"]),
+            media_type="image/png",
+            coords=parse_coords(result["coords"]),
+            content_list=load_literal(content_list) if isinstance(content_list, str) else content_list,
+        )
+
+    def close(self):
+        self.session.close()
+
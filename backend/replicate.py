@@ -1,133 +1,237 @@
+import asyncio
 import base64
+import io
 import json
 import logging
 import os
 import time
+import weakref
 from dataclasses import dataclass
 from typing import Dict, List, Tuple, Optional
 
+import numpy as np
 import pyautogui
-import requests
 from PIL import Image, ImageGrab
-from anthropic import Anthropic
+from anthropic import Anthropic, AsyncAnthropic
+
+from element_context import element_table
+from parser_client import ParsedScreen, ParserClient
+from prompts import locate_element_prompt
+from resolutions import RESOLUTION_CACHE, ResolutionCache
+from screen_cache import ScreenCache
+from utils import changed_area
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 GRID_SIZE = 10
+# Screenshots are downscaled to fit the size the model works at
 maxWidth = 1456
 maxHeight = 819
+# JPEG is several times smaller and faster to encode than PNG; set PNG for lossless captures
+SCREENSHOT_FORMAT = os.environ.get("SCREENSHOT_FORMAT", "JPEG").upper()
+SCREENSHOT_QUALITY = int(os.environ.get("SCREENSHOT_QUALITY", "85"))
+MEDIA_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+# Delay pyautogui adds after each call, in seconds; waiting for the UI is done by watching the screen
+ACTION_PAUSE = float(os.environ.get("ACTION_PAUSE", "0.05"))
+# The UI has settled once the screen stayed the same for SETTLE_QUIET seconds, or after SETTLE_TIMEOUT
+SETTLE_QUIET = float(os.environ.get("SETTLE_QUIET", "0.3"))
+SETTLE_TIMEOUT = float(os.environ.get("SETTLE_TIMEOUT", "5"))
+SETTLE_INTERVAL = 0.05  # Seconds between two screen samples
+SETTLE_WIDTH = 320  # Screen samples are compared at this width
+SETTLE_THRESHOLD = 24  # Pixel difference counted as a change, as VideoOptions.threshold
 
 screen_width, screen_height = pyautogui.size()
 
 API_KEY = os.environ.get("ANTHROPIC_KEY")
+ELEMENT_MODEL = "claude-3-5-sonnet-latest"
 
 @dataclass
 class UIAction:
-    coordinates: Tuple[int, int]
+    coordinates: Tuple[int, int]  # In screenshot pixels, see Screenshot.to_screen
     text_input: str
 
 
+@dataclass
+class Screenshot:
+    image: Image.Image  # Downscaled capture
+    scale_x: float  # Screen points per screenshot pixel
+    scale_y: float
+
+    def to_screen(self, x: float, y: float) -> Tuple[int, int]:
+        """Map screenshot pixel coordinates to the screen coordinates pyautogui uses."""
+        return round(x * self.scale_x), round(y * self.scale_y)
+
+
+@dataclass
+class StepReport:
+    """Cost of locating the element of one step."""
+    outcome: str
+    source: str  # "model", or "cache" when the resolution cache answered
+    seconds: float  # Parse and model call
+    elements: int  # Elements on the screen
+    listed: int = 0  # Elements in the element table
+    input_tokens: int = 0  # Not read from the prompt cache
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+    output_tokens: int = 0
+
+    def add_usage(self, usage):
+        self.input_tokens += usage.input_tokens
+        self.output_tokens += usage.output_tokens
+        self.cache_read_tokens += getattr(usage, "cache_read_input_tokens", None) or 0
+        self.cache_write_tokens += getattr(usage, "cache_creation_input_tokens", None) or 0
+
+    def summary(self) -> str:
+        if self.source == "cache":
+            return f"'{self.outcome}': resolution cache, {self.seconds:.2f}s"
+        return (f"'{self.outcome}': {self.seconds:.2f}s, {self.listed}/{self.elements} elements, "
+                f"{self.input_tokens} input + {self.cache_read_tokens} cached + {self.cache_write_tokens} "
+                f"cache write + {self.output_tokens} output tokens")
+
+
 class AutomationSystem:
     def __init__(self, anthropic_api_key: str):
         # self.client = Anthropic(api_key=anthropic_api_key)
         self.client = Anthropic(api_key=API_KEY)
+        # httpx connections are bound to an event loop, and every execute_steps runs its own
+        self.async_clients = weakref.WeakKeyDictionary()  # loop -> AsyncAnthropic
         self.max_retries = 3
-        pyautogui.PAUSE = 0.5  # Add small delay between actions
+        self.parser = ParserClient()
+        # Consecutive steps on the same screen share one parse
+        self.screens = ScreenCache(self.send_photo)
+        # Elements chosen on earlier runs of the same steps
+        self.resolutions = ResolutionCache(ELEMENT_MODEL) if RESOLUTION_CACHE else None
+        self.reports: List[StepReport] = []
+        pyautogui.PAUSE = ACTION_PAUSE
 
-    def take_screenshot(self) -> Image.Image:
-        """Capture the current screen."""
-        screenshot = ImageGrab.grab()
-        return screenshot
+    @property
+    def async_client(self) -> AsyncAnthropic:
+        """The AsyncAnthropic client of the running event loop."""
+        loop = asyncio.get_running_loop()
+        if loop not in self.async_clients:
+            self.async_clients[loop] = AsyncAnthropic(api_key=API_KEY)
+        return self.async_clients[loop]
 
-    def encode_image_base64(self, image: Image.Image) -> str:
-        """Convert PIL Image to base64 string."""
-        import io
+    def take_screenshot(self, image: Optional[Image.Image] = None) -> Screenshot:
+        """
+        Capture the current screen (or use a capture), downscaled to fit
+        maxWidth x maxHeight. The scale factors are relative to pyautogui's
+        screen size, which also accounts for HiDPI displays capturing at
+        twice that size.
+        """
+        image = image or ImageGrab.grab()
+        factor = min(maxWidth / image.width, maxHeight / image.height, 1)
+        if factor < 1:
+            size = (max(1, round(image.width * factor)), max(1, round(image.height * factor)))
+            # reducing_gap shrinks by whole factors first, much faster than a plain resample
+            image = image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+        return Screenshot(image, screen_width / image.width, screen_height / image.height)
+
+    def encode_image(self, image: Image.Image, image_format: str = SCREENSHOT_FORMAT) -> bytes:
+        """Encode a PIL Image in image_format."""
         buffer = io.BytesIO()
-        image.save(buffer, format="PNG")
-        return base64.b64encode(buffer.getvalue()).decode()
+        if image_format == "PNG":
+            image.save(buffer, format="PNG", compress_level=1)
+        else:
+            # JPEG has no alpha channel, some platforms capture RGBA
+            image.convert("RGB").save(buffer, format=image_format, quality=SCREENSHOT_QUALITY)
+        return buffer.getvalue()
 
-    def send_photo(self, screenshot: str) -> (str, dict[str, str], list):
-        response = requests.post("http://79.117.18.84:38414/file", json={"image": screenshot})
-        json = response.json()
-        img_base64 = json.get("photo")
+    def encode_image_base64(self, image: Image.Image, image_format: str = SCREENSHOT_FORMAT) -> str:
+        """Convert PIL Image to base64 string."""
+        return base64.b64encode(self.encode_image(image, image_format)).decode()
 
-        # Decode and convert to PIL Image
-        return img_base64, eval(json.get('coords')), json.get('content_list')
+    def send_photo(self, image: Image.Image) -> ParsedScreen:
+        """Find the UI elements of a screenshot, or a part of it, with the parser service."""
+        return self.parser.parse(self.encode_image(image), MEDIA_TYPES[SCREENSHOT_FORMAT])
 
-    def get_element_location(self, screenshot: Image.Image, element_description: str, context: str) -> Optional[
-        UIAction]:
+    def element_request(self, parsed: ParsedScreen, element_description: str, context: str) -> Tuple[dict, int]:
         """
-        Use Claude 3.5 API to analyze screenshot and find precise element coordinates.
-        Returns coordinates normalized to current screen resolution.
-        """
-        encoded_img = self.encode_image_base64(screenshot)
-        encoded_image, coords, content_list = self.send_photo(encoded_img)
-        system = f"""You are Screen Helper, a world-class reasoning engine whose task is to help users select the correct elements on a computer screen to complete a task. 
-
-        Your selection choices will be used on a user's personal computer to help them complete a task. A task is decomposed into a series of steps, each of which requires the user to select a specific element on the screen. Your specific role is to select the best screen element for the current step. Assume that the rest of the reasoning and task breakdown will be done by other AI models.
-        
-        When you output actions, they will be executed **on the user's computer**. The user has given you **full and complete permission** to select any element necessary to complete the task.
-        
-        # Inputs
-        
-        You will receive as input the user's current screen, and a text instruction with the current step's objective.
-        
-        0) Step objective: string with the system's current goal.
-        
-        Since you are a text-only model, the current screen will be represented as:
-        
-        1. State description: 
-        A string with the title of the active window.
-        
-        2) Text rendering: 
-        A multi-line block of text with the screen's text contents, rendered with their approximate screen locations. Note that none of the images or icons will be present in the text representation, even though they are visible on the real computer screen, and you should consider them in your reasoning. This input is extremely important for you to understand the spatial relationship between the screen elements, since you cannot see the screen directly. You need to imagine the screen layout based on this text rendering. The text elements are extracted directly from this layout.
-        
-        # Output
-        
-        Your goal is to analyze all the inputs and select the best screen element to fulfill the current step's objective. You should output the following items, in a JSON format. Just these keys no reasoning:
-        1. element id
-        2. text input if needed
-        CRITICAL INSTRUCTIONS:
-        Return your response in this exact JSON format:
-        DO NOT TYPE ANYTHING ELSE AS THE OUTPUT NEEDS TO BE PARSED AS A JSON!!! Output only this
-        {{
-            "element_id": number,
-            "text_input": "text to type if needed",
-        }}
-        """
-        message = self.client.messages.create(
-            model="claude-3-5-sonnet-latest",
+        Arguments of the messages.create call choosing the element of a
+        step on a parsed screen, and the number of elements it lists.
+        """
+        table, listed = element_table(parsed, f"{element_description} {context}")
+        request = dict(
+            model=ELEMENT_MODEL,
             max_tokens=1000,
             temperature=1,
-            system=system,
+            # The same for every step, so the provider can cache it
+            system=[{"type": "text", "text": locate_element_prompt, "cache_control": {"type": "ephemeral"}}],
             messages=[{
                 "role": "user",
                 "content": [
                     {"type": "text",
-                     "text": f"Find the exact coordinates of this element: {element_description}, context : {context}, coords : {coords}, element ids: {content_list}"},
-                    {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": encoded_image}}
+                     "text": f"Step objective: {element_description}\nState description: {context}\n"
+                             f"Element table:\n{table}"},
+                    {"type": "image", "source": {"type": "base64", "media_type": parsed.media_type,
+                                                 "data": base64.b64encode(parsed.image).decode()}}
                 ]
             }]
         )
+        return request, listed
 
+    def element_choice(self, message) -> Tuple[str, str]:
+        """(element id, text input) of the model's answer to element_request."""
         print(message.content[0].text)
         result = json.loads(message.content[0].text)
+        return str(result['element_id']), result["text_input"]
 
-        el_id = result['element_id']
-
-        (x, y, w, h) = coords[str(el_id)]
+    def element_action(self, parsed: ParsedScreen, el_id: str, text_input: str) -> UIAction:
+        (x, y, w, h) = parsed.coords[el_id]
 
         return UIAction(
             coordinates=(x + (w//2), y + (h//2)),
-            text_input=result["text_input"],
+            text_input=text_input,
         )
 
-    def verify_action(self, screenshot: Image.Image, expected_outcome: str) -> bool:
+    def get_element_location(self, screenshot: Screenshot, element_description: str, context: str) -> Optional[
+        UIAction]:
+        """
+        Use Claude 3.5 API to analyze screenshot and find precise element coordinates.
+        Returns coordinates in screenshot pixels.
+        """
+        parsed = self.screens.get(screenshot.image)
+        request, listed = self.element_request(parsed, element_description, context)
+        message = self.client.messages.create(**request)
+        return self.element_action(parsed, *self.element_choice(message))
+
+    def resolve(self, screenshot: Screenshot, step: Dict[str, str]):
+        """(fingerprint, parsed screen, cached (element id, text input) or None) of a step's screenshot."""
+        fingerprint, parsed = self.screens.lookup(screenshot.image)
+        cached = self.resolutions.find(step, fingerprint, parsed) if self.resolutions else None
+        return fingerprint, parsed, cached
+
+    async def locate(self, screenshot: Screenshot, step: Dict[str, str]) -> UIAction:
+        """
+        get_element_location for a step, without blocking the event loop.
+        The model is only asked when no earlier run resolved the step on
+        this screen.
+        """
+        start = time.perf_counter()
+        fingerprint, parsed, cached = await asyncio.to_thread(self.resolve, screenshot, step)
+        report = StepReport(step['outcome'], "cache", 0.0, len(parsed.coords))
+        if cached:
+            el_id, text_input = cached
+        else:
+            report.source = "model"
+            request, report.listed = self.element_request(parsed, step['outcome'], step['state_description'])
+            message = await self.async_client.messages.create(**request)
+            report.add_usage(message.usage)
+            el_id, text_input = self.element_choice(message)
+        action = self.element_action(parsed, el_id, text_input)
+        if self.resolutions and not cached:
+            await asyncio.to_thread(self.resolutions.add, step, fingerprint, parsed, el_id, text_input)
+        report.seconds = time.perf_counter() - start
+        self.reports.append(report)
+        logger.info(report.summary())
+        return action
+
+    def verify_action(self, screenshot: Screenshot, expected_outcome: str) -> bool:
         """
         Verify if the action produced the expected outcome by analyzing the screenshot.
         """
-        encoded_image = self.encode_image_base64(screenshot)
+        encoded_image = self.encode_image_base64(screenshot.image)
 
         try:
             message = self.client.messages.create(
@@ -140,7 +244,8 @@ class AutomationSystem:
                         {"type": "text",
                          "text": f"Does this screenshot show the following outcome: {expected_outcome}?"},
                         {"type": "image",
-                         "source": {"type": "base64", "media_type": "image/png", "data": encoded_image}}
+                         "source": {"type": "base64", "media_type": MEDIA_TYPES[SCREENSHOT_FORMAT],
+                                    "data": encoded_image}}
                     ]
                 }]
             )
@@ -152,52 +257,130 @@ class AutomationSystem:
             logger.error(f"Error verifying action: {str(e)}")
             return False
 
+    def act(self, screenshot: Screenshot, element: UIAction, action: str):
+        """Perform an action on the element of a screenshot."""
+        # Scale coordinates to current screen resolution
+        x, y = screenshot.to_screen(*element.coordinates)
+        print(f"{action} at: {x}, {y}")
+        # Perform the action based on action type
+        if action == 'left_click':
+            pyautogui.click(x, y)
+        elif action == 'double_click':
+            pyautogui.doubleClick(x, y)
+        elif action == 'right_click':
+            print(f"rightclick at {x, y}")
+            pyautogui.rightClick(x, y)
+        elif action == 'keyboard_input':
+            pyautogui.click(x, y)
+            pyautogui.write(element.text_input)
+            pyautogui.press('enter')
+        elif action == 'hover':
+            pyautogui.moveTo(x, y)
+
+    async def settle(self, next_step: Optional[Dict[str, str]] = None):
+        """
+        Wait until the screen stops changing, and return its last
+        screenshot with the task locating next_step on it (None without
+        a next step).
+
+        Locating starts at the first sample equal to the one before it,
+        and is cancelled and started again if the screen changes after
+        that, so it mostly runs while the quiet period is being waited for.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SETTLE_TIMEOUT
+        previous = None
+        quiet_since = None
+        located = None  # (screenshot, task) of the speculative locate
+        while True:
+            capture = await asyncio.to_thread(ImageGrab.grab)
+            now = loop.time()
+            # Box-filter downscale, a few ms even for a HiDPI capture
+            gray = np.asarray(capture.reduce(max(1, capture.width // SETTLE_WIDTH)).convert("L"))
+            # The cheap diff of process_video; a caret or a spinner is a change too
+            changed = previous is None or changed_area(previous, gray, SETTLE_THRESHOLD, 4) > 4
+            previous = gray
+            if changed:
+                quiet_since = None
+                if located:
+                    located[1].cancel()
+                    located = None
+            else:
+                quiet_since = quiet_since or now
+                if next_step and located is None:
+                    screenshot = await asyncio.to_thread(self.take_screenshot, capture)
+                    located = screenshot, asyncio.create_task(self.locate(screenshot, next_step))
+                if now - quiet_since >= SETTLE_QUIET:
+                    break
+            if now >= deadline:
+                logger.warning(f"Screen still changing after {SETTLE_TIMEOUT}s")
+                break
+            await asyncio.sleep(SETTLE_INTERVAL)
+
+        if located:
+            return located
+        screenshot = await asyncio.to_thread(self.take_screenshot, capture)
+        return screenshot, asyncio.create_task(self.locate(screenshot, next_step)) if next_step else None
+
     def perform_action(self, action_dict: Dict[str, str]) -> bool:
         """
-        Perform a single action and verify its outcome.
+        Perform a single action and wait for the UI to settle.
         Returns True if action was successful, False otherwise.
         """
-        for attempt in range(self.max_retries):
-            # Take screenshot and get element location
-            screenshot = self.take_screenshot()
-            element = self.get_element_location(screenshot, action_dict['outcome'], action_dict['state_description'])
-
-            # Scale coordinates to current screen resolution
-            x = int(element.coordinates[0])
-            y = int(element.coordinates[1])
-            action = action_dict['action']
-            print(f"{action} at: {x}, {y}")
-            # Perform the action based on action type
-            if action == 'left_click':
-                pyautogui.click(x, y)
-            elif action == 'double_click':
-                pyautogui.doubleClick(x, y)
-            elif action == 'right_click':
-                print(f"rightclick at {x, y}")
-                pyautogui.rightClick(x, y)
-            elif action == 'keyboard_input':
-                pyautogui.click(x, y)
-                pyautogui.write(element.text_input)
-                pyautogui.press('enter')
-            elif action == 'hover':
-                pyautogui.moveTo(x, y)
-
-            # Verify the outcome
-            time.sleep(0.5)  # Wait for UI to update
-            verification_screenshot = self.take_screenshot()
+        return asyncio.run(self.run_steps([action_dict]))
+
+    async def run_steps(self, steps: List[Dict[str, str]]) -> bool:
+        """execute_steps_async in an event loop of its own, closing the loop's client once done."""
+        try:
+            return await self.execute_steps_async(steps)
+        finally:
+            client = self.async_clients.pop(asyncio.get_running_loop(), None)
+            if client is not None:
+                await client.close()
+
+    async def execute_steps_async(self, steps: List[Dict[str, str]]) -> bool:
+        """
+        Execute a sequence of steps, locating the element of each step
+        while the UI settles from the previous one.
+        """
+        if not steps:
             return True
-        logger.error(f"Action failed after {self.max_retries} attempts: {action_dict}")
-        return False
+        first_report = len(self.reports)
+        screenshot, located = await self.settle(steps[0])
+        for position, step in enumerate(steps):
+            start = time.perf_counter()
+            for attempt in range(self.max_retries):
+                try:
+                    element = await located
+                    break
+                except Exception as e:
+                    logger.warning(f"Locating element failed (attempt {attempt + 1}): {e}")
+                    if attempt + 1 < self.max_retries:
+                        screenshot = await asyncio.to_thread(self.take_screenshot)
+                        located = asyncio.create_task(self.locate(screenshot, step))
+            else:
+                logger.error(f"Action failed after {self.max_retries} attempts: {step}")
+                return False
+            waited = time.perf_counter() - start
+
+            self.act(screenshot, element, step['action'])
+            next_step = steps[position + 1] if position + 1 < len(steps) else None
+            screenshot, located = await self.settle(next_step)
+            logger.info(f"Step {position + 1}/{len(steps)}: waited {waited:.2f}s for its element, "
+                        f"{time.perf_counter() - start - waited:.2f}s to act and settle")
+        reports = self.reports[first_report:]
+        logger.info(f"{len(steps)} steps: {sum(report.source == 'model' for report in reports)} model calls, "
+                    f"{sum(report.input_tokens for report in reports)} input, "
+                    f"{sum(report.cache_read_tokens for report in reports)} cached and "
+                    f"{sum(report.output_tokens for report in reports)} output tokens")
+        return True
 
     def execute_steps(self, steps: List[Dict[str, str]]) -> bool:
         """
         Execute a sequence of steps.
         Returns True if all steps completed successfully, False otherwise.
         """
-        for step in steps:
-            if not self.perform_action(step):
-                return False
-        return True
+        return asyncio.run(self.run_steps(steps))
 
 
 # Example usage
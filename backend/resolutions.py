@@ -0,0 +1,87 @@
+"""
+Elements the model chose for the steps of AutomationSystem, so that
+replaying the same steps on the same screens needs no model call.
+
+A resolution is keyed by the step, the model, the dHash of the screen
+and the set of element boxes the parser found on it. It is only used if
+the element it chose is still on the screen at about the same place.
+"""
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from cache import ResultCache
+from parser_client import ParsedScreen
+from prompts import locate_element_prompt
+
+RESOLUTION_CACHE = os.environ.get("RESOLUTION_CACHE", "true").lower() in ("1", "true", "yes")
+# Changing the prompt invalidates every cached resolution
+PROMPT_VERSION = hashlib.sha256(locate_element_prompt.encode()).hexdigest()[:16]
+# Element boxes are compared on a grid of this many screenshot pixels, to absorb parser jitter
+ELEMENT_GRID = 16
+# Minimum intersection over union of a cached element and its match on the current screen
+MIN_IOU = 0.5
+
+
+def element_content(parsed: ParsedScreen, element_id: str) -> Optional[str]:
+    if element_id.isdigit() and int(element_id) < len(parsed.content_list):
+        content = parsed.content_list[int(element_id)]
+        return str(content) if content is not None else None
+    return None
+
+
+def elements_signature(coords: Dict[str, List[float]]) -> str:
+    boxes = sorted({tuple(round(v / ELEMENT_GRID) for v in box) for box in coords.values()})
+    return hashlib.sha256(json.dumps(boxes).encode()).hexdigest()
+
+
+def iou(a, b):
+    width = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    height = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    return intersection / (a[2] * a[3] + b[2] * b[3] - intersection)
+
+
+@dataclass
+class Resolution:
+    box: List[float]  # The chosen element when it was resolved
+    content: Optional[str]  # Its content_list entry
+    text_input: str
+
+
+class ResolutionCache:
+    def __init__(self, model: str, cache: Optional[ResultCache] = None):
+        self.model = model
+        self.cache = cache or ResultCache("resolutions")
+        self.counters = {"hits": 0, "misses": 0, "stale": 0}
+
+    def key(self, step: Dict[str, str], fingerprint: int, parsed: ParsedScreen) -> str:
+        fields = [self.model, PROMPT_VERSION, step.get("action"), step.get("outcome"), step.get("state_description"),
+                  fingerprint, elements_signature(parsed.coords)]
+        return hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+
+    def find(self, step: Dict[str, str], fingerprint: int, parsed: ParsedScreen) -> Optional[Tuple[str, str]]:
+        """(element id, text input) on the current screen of a cached resolution, or None."""
+        resolution = self.cache.get(self.key(step, fingerprint, parsed))
+        if resolution is None:
+            self.counters["misses"] += 1
+            return None
+        # Ids may differ between parses, look the element up by place and content
+        best, best_iou = None, MIN_IOU
+        for element_id, box in parsed.coords.items():
+            overlap = iou(resolution.box, box)
+            if overlap >= best_iou and element_content(parsed, element_id) == resolution.content:
+                best, best_iou = element_id, overlap
+        if best is None:
+            self.counters["stale"] += 1
+            return None
+        self.counters["hits"] += 1
+        return best, resolution.text_input
+
+    def add(self, step: Dict[str, str], fingerprint: int, parsed: ParsedScreen, element_id: str, text_input: str):
+        resolution = Resolution(parsed.coords[element_id], element_content(parsed, element_id), text_input)
+        self.cache.put(self.key(step, fingerprint, parsed), resolution)
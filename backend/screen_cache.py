@@ -0,0 +1,202 @@
+"""
+Parsed screens of AutomationSystem, reused while the screen stays the
+same. A screenshot is matched to the closest cached one by perceptual
+hash, then compared with it the way process_video compares frames:
+
+- nothing changed: the cached elements are returned without calling the parser
+- a few small regions changed: only those regions are parsed, and their
+  elements replace the cached ones they overlap
+- otherwise the whole screenshot is parsed
+
+Element ids are the parser's: content_list[i] describes coords[str(i)].
+Ids of elements dropped by a partial parse are not reused, their
+content_list entry is None.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from dedup import dhash
+from parser_client import ParsedScreen
+from utils import changed_regions, reduce_frame
+
+logger = logging.getLogger(__name__)
+
+# Parsed screens kept; 0 disables the cache
+SCREEN_CACHE_SIZE = int(os.environ.get("SCREEN_CACHE_SIZE", "8"))
+# Changes covering more than this fraction of the screen are parsed as a whole screen
+PARTIAL_PARSE_MAX_AREA = float(os.environ.get("PARTIAL_PARSE_MAX_AREA", "0.3"))
+PARTIAL_PARSE_MAX_REGIONS = 4
+# Context parsed around a changed region, in screenshot pixels, so that its elements are seen whole
+REGION_MARGIN = 24
+
+
+def intersects(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+def merge_boxes(boxes):
+    """Union of overlapping (x, y, width, height) boxes, until none overlap."""
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                if intersects(boxes[i], boxes[j]):
+                    (x1, y1, w1, h1), (x2, y2, w2, h2) = boxes[i], boxes.pop(j)
+                    x, y = min(x1, x2), min(y1, y2)
+                    boxes[i] = (x, y, max(x1 + w1, x2 + w2) - x, max(y1 + h1, y2 + h2) - y)
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+@dataclass
+class CachedScreen:
+    gray: np.ndarray  # Downscaled grayscale screenshot, as compared by process_video
+    fingerprint: int  # dHash of gray
+    parsed: ParsedScreen
+
+
+@dataclass
+class ScreenCacheStats:
+    hits: int = 0  # Screens answered from the cache
+    partial: int = 0  # Screens answered by parsing changed regions only
+    full: int = 0  # Screens parsed whole
+    regions: int = 0  # Regions parsed by partial parses
+
+    def to_dict(self):
+        return {"hits": self.hits, "partial": self.partial, "full": self.full, "regions": self.regions}
+
+
+class ScreenCache:
+    """
+    parse: parses a PIL image, the whole screenshot or a crop of it.
+    threshold and min_area (in screenshot pixels) tell which differences
+    between two screenshots are changes; they are lower than
+    VideoOptions', as a single new menu item matters here.
+    """
+
+    def __init__(self, parse: Callable[[Image.Image], ParsedScreen], size: int = SCREEN_CACHE_SIZE,
+                 threshold: int = 24, min_area: int = 64, detect_width: int = 640,
+                 max_area: float = PARTIAL_PARSE_MAX_AREA, max_regions: int = PARTIAL_PARSE_MAX_REGIONS):
+        self.parse = parse
+        self.size = size
+        self.threshold = threshold
+        self.min_area = min_area
+        self.detect_width = detect_width
+        self.max_area = max_area
+        self.max_regions = max_regions
+        self.screens = OrderedDict()  # fingerprint -> CachedScreen, least recently used first
+        self.stats = ScreenCacheStats()
+        # Parses run in threads, and a cancelled one may still be running
+        self.lock = threading.Lock()
+
+    def get(self, image: Image.Image) -> ParsedScreen:
+        """Elements of a screenshot, parsing no more of it than changed since a cached one."""
+        return self.lookup(image)[1]
+
+    def lookup(self, image: Image.Image) -> Tuple[int, ParsedScreen]:
+        """(dHash of the screenshot, its elements)."""
+        with self.lock:
+            return self._lookup(image)
+
+    def _lookup(self, image: Image.Image) -> Tuple[int, ParsedScreen]:
+        frame = cv2.cvtColor(np.asarray(image.convert("RGB")), cv2.COLOR_RGB2BGR)
+        gray = reduce_frame(frame, self.detect_width)
+        fingerprint = dhash(gray)
+        if not self.size:
+            self.stats.full += 1
+            return fingerprint, self.parse(image)
+
+        cached = self.closest(fingerprint, gray.shape)
+        parsed = None
+        if cached is not None:
+            scale = frame.shape[1] / gray.shape[1]
+            regions = changed_regions(cached.gray, gray, self.threshold, self.min_area / scale ** 2)
+            if not regions:
+                self.stats.hits += 1
+                self.screens.move_to_end(cached.fingerprint)
+                logger.info("Screen unchanged, parse skipped")
+                return fingerprint, cached.parsed
+            # Back to screenshot pixels
+            regions = [tuple(round(v * scale) for v in region) for region in regions]
+            parsed = self.parse_regions(cached.parsed, image, frame, regions)
+
+        if parsed is None:
+            self.stats.full += 1
+            parsed = self.parse(image)
+        self.screens[fingerprint] = CachedScreen(gray, fingerprint, parsed)
+        self.screens.move_to_end(fingerprint)
+        while len(self.screens) > self.size:
+            self.screens.popitem(last=False)
+        return fingerprint, parsed
+
+    def closest(self, fingerprint, shape) -> Optional[CachedScreen]:
+        candidates = [screen for screen in self.screens.values() if screen.gray.shape == shape]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda screen: bin(screen.fingerprint ^ fingerprint).count("1"))
+
+    def parse_regions(self, cached: ParsedScreen, image, frame, regions) -> Optional[ParsedScreen]:
+        """
+        Merge the elements of the changed regions into the cached ones, or
+        None when too much changed for it to be worth it.
+        """
+        height, width = frame.shape[:2]
+        crops = merge_boxes([(max(0, x - REGION_MARGIN), max(0, y - REGION_MARGIN),
+                              min(width, x + w + REGION_MARGIN) - max(0, x - REGION_MARGIN),
+                              min(height, y + h + REGION_MARGIN) - max(0, y - REGION_MARGIN))
+                             for x, y, w, h in regions])
+        if len(crops) > self.max_regions or sum(w * h for _, _, w, h in crops) > self.max_area * width * height:
+            return None
+        annotated = cv2.imdecode(np.frombuffer(cached.image, np.uint8), cv2.IMREAD_COLOR)
+        if annotated is None or annotated.shape[:2] != (height, width):
+            return None
+
+        coords = {element_id: box for element_id, box in cached.coords.items()
+                  if not any(intersects(box, region) for region in regions)}
+        content_list = list(cached.content_list)
+        for element_id in cached.coords.keys() - coords.keys():
+            if element_id.isdigit() and int(element_id) < len(content_list):
+                content_list[int(element_id)] = None
+        next_id = max([int(i) + 1 for i in cached.coords if i.isdigit()] + [len(content_list)])
+        content_list += [None] * (next_id - len(content_list))
+
+        # Labels drawn over the changed regions are stale
+        for x, y, w, h in regions:
+            annotated[y:y + h, x:x + w] = frame[y:y + h, x:x + w]
+        for x, y, w, h in crops:
+            parsed = self.parse(image.crop((x, y, x + w, y + h)))
+            for local_id, (bx, by, bw, bh) in parsed.coords.items():
+                box = [bx + x, by + y, bw, bh]
+                # Elements of the margin are already cached
+                if not any(intersects(box, region) for region in regions):
+                    continue
+                local = int(local_id) if local_id.isdigit() else -1
+                coords[str(next_id)] = box
+                content_list.append(parsed.content_list[local] if 0 <= local < len(parsed.content_list) else None)
+                draw_element(annotated, next_id, box)
+                next_id += 1
+
+        self.stats.partial += 1
+        self.stats.regions += len(crops)
+        logger.info(f"Screen partly changed, parsed {len(crops)} regions")
+        ret, buffer = cv2.imencode(".png", annotated, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        return ParsedScreen(image=buffer.tobytes(), media_type="image/png", coords=coords, content_list=content_list)
+
+
+def draw_element(image, element_id, box):
+    x, y, w, h = (round(v) for v in box)
+    cv2.rectangle(image, (x, y), (x + w, y + h), (0, 0, 255), 2)
+    cv2.putText(image, str(element_id), (x, max(12, y - 3)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
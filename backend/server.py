@@ -1,8 +1,18 @@
-from fastapi import File, Form, UploadFile, FastAPI
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-from fastapi.responses import JSONResponse
-from utils import analyze_video, process_video
+import asyncio
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from contextlib import asynccontextmanager
+from cache import ResultCache
+from frame_store import EVICT_INTERVAL, FRAME_TTL, MIME_TYPES, FrameStore
+from jobs import JobManager, QueueFullError
+from uploads import Upload, receive_upload
+from utils import VideoOptions, remove_file
+import llm_client
+import metrics
+import time
+import uuid
 
 # from PIL import Image
 # from utils import get_som_labeled_img, check_ocr_box, get_caption_model_processor, get_yolo_model
@@ -13,8 +23,8 @@ import json
 import base64
 from pydantic import BaseModel
 from io import BytesIO
-import tempfile
 import os
+from typing import Optional
 
 # device = 'cuda'
 
@@ -27,7 +37,44 @@ import os
 
 # som_model.device, type(som_model)
 
-app = FastAPI()
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_MB", "1024")) * 1024 * 1024
+# Room for the multipart boundaries and the other form fields, which are limited to it
+FORM_OVERHEAD_BYTES = 64 * 1024
+# Processes decoding separate time ranges of a single long video
+SEGMENT_WORKERS = int(os.environ.get("SEGMENT_WORKERS", "1"))
+# Back off while the screen is static and bisect changes to their first frame; only faster with seeking
+ADAPTIVE_SAMPLING = os.environ.get("ADAPTIVE_SAMPLING", "false").lower() in ("1", "true", "yes")
+# Samples to learn flickering pixels (caret, spinners) from, which are then ignored; 0 disables. Off by default,
+# UI toggled a few times while learning would be masked for the rest of the video
+FLICKER_SAMPLES = int(os.environ.get("FLICKER_SAMPLES", "0"))
+# Keyframe encoding
+FRAME_CODEC = os.environ.get("FRAME_CODEC", "jpeg")
+FRAME_QUALITY = int(os.environ.get("FRAME_QUALITY", "90"))
+FRAME_MAX_WIDTH = int(os.environ.get("FRAME_MAX_WIDTH", "1920"))
+FRAME_MAX_HEIGHT = int(os.environ.get("FRAME_MAX_HEIGHT", "1080"))
+FRAME_SAVE_DIR = os.environ.get("FRAME_SAVE_DIR") or None
+
+job_manager = JobManager(keyframe_cache=ResultCache("keyframes"), analysis_cache=ResultCache("analysis"))
+# Keyframes are written here by the decoding processes and served from /frames/
+frame_store = FrameStore()
+metrics.registry.gauge("video_jobs_pending", "Jobs decoding or analyzing", lambda: job_manager.pending_count())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async def evict_frames():
+        while True:
+            await asyncio.to_thread(frame_store.evict)
+            await asyncio.sleep(EVICT_INTERVAL)
+
+    eviction = asyncio.create_task(evict_frames())
+    yield
+    eviction.cancel()
+    job_manager.shutdown()
+    await llm_client.async_clients.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -37,6 +84,142 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    # Reject oversized uploads from the header, before the body is read
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES:
+        return JSONResponse(status_code=413, content={"detail": "Upload too large"})
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    """
+    Collect the stage timings of the request for its Server-Timing header,
+    and profile it when asked to with an "X-Profile: 1" header.
+    """
+    timings = metrics.Timings()
+    token = metrics.request_timings.set(timings)
+    profiler = None
+    if metrics.PROFILE_REQUESTS and request.headers.get("x-profile") == "1":
+        profiler = metrics.SamplingProfiler().start()
+    try:
+        response = await call_next(request)
+    finally:
+        metrics.request_timings.reset(token)
+
+    # Stages that run while a streamed body is sent are not in the header
+    response.headers["Server-Timing"] = timings.header()
+    if profiler:
+        profile_name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        response.headers["X-Profile"] = profile_name
+
+    route = request.scope.get("route")
+    body = response.body_iterator
+
+    async def finish():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            metrics.registry.observe("http_request_seconds", timings.elapsed(), method=request.method,
+                                     route=getattr(route, "path", "unmatched"), status=response.status_code)
+            if profiler:
+                # Joining the sampling thread and writing the profile would block the event loop
+                await asyncio.to_thread(profiler.stop)
+                await asyncio.to_thread(profiler.save, profile_name)
+
+    response.body_iterator = finish()
+    return response
+
+
+async def receive_video(request: Request) -> tuple[Upload, VideoOptions]:
+    """
+    Receive the video and the form fields of an upload: file, api_key,
+    model and optionally sample_rate, roi and mask. The caller must remove
+    upload.path.
+    """
+    with metrics.stage("upload_receive"):
+        upload = await receive_upload(request, MAX_UPLOAD_BYTES, FORM_OVERHEAD_BYTES)
+    try:
+        missing = [name for name in ("api_key", "model") if not upload.fields.get(name)]
+        if missing:
+            raise HTTPException(status_code=422, detail=f"{' and '.join(missing)} required")
+        try:
+            sample_rate = float(upload.fields["sample_rate"]) if upload.fields.get("sample_rate") else None
+        except ValueError:
+            raise HTTPException(status_code=422, detail="sample_rate must be a number")
+        options = video_options(sample_rate, upload.fields.get("roi"), upload.fields.get("mask"))
+    except BaseException:
+        remove_file(upload.path)
+        raise
+    metrics.registry.inc("video_upload_bytes_total", upload.size)
+    return upload, options
+
+
+def parse_box(value, name: str):
+    if not (isinstance(value, list) and len(value) == 4 and all(isinstance(v, int) and v >= 0 for v in value)
+            and value[2] > 0 and value[3] > 0):
+        raise HTTPException(status_code=400, detail=f"{name} must be [x, y, width, height] in pixels")
+    return tuple(value)
+
+
+def video_options(sample_rate: Optional[float], roi: Optional[str] = None, mask: Optional[str] = None) -> VideoOptions:
+    """roi is a JSON [x, y, width, height] box, mask a JSON list of them."""
+    options = VideoOptions(workers=SEGMENT_WORKERS, adaptive=ADAPTIVE_SAMPLING, codec=FRAME_CODEC,
+                           quality=FRAME_QUALITY, max_width=FRAME_MAX_WIDTH, max_height=FRAME_MAX_HEIGHT,
+                           save_dir=FRAME_SAVE_DIR, frame_store=frame_store, flicker_samples=FLICKER_SAMPLES)
+    if sample_rate:
+        options.sample_rate = sample_rate
+    try:
+        if roi:
+            options.roi = parse_box(json.loads(roi), "roi")
+        if mask:
+            boxes = json.loads(mask)
+            if not isinstance(boxes, list):
+                raise HTTPException(status_code=400, detail="mask must be a list of [x, y, width, height] boxes")
+            options.mask_regions = [parse_box(box, "mask box") for box in boxes]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="roi and mask must be JSON")
+    return options
+
+
+# The video endpoints parse their multipart body themselves, see uploads.py
+VIDEO_FORM = {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+    "type": "object",
+    "required": ["file", "api_key", "model"],
+    "properties": {
+        "file": {"type": "string", "format": "binary"},
+        "api_key": {"type": "string"},
+        "model": {"type": "string"},
+        "sample_rate": {"type": "number"},
+        "roi": {"type": "string", "description": "JSON [x, y, width, height] box"},
+        "mask": {"type": "string", "description": "JSON list of [x, y, width, height] boxes"},
+    },
+}}}}}
+
+
+def too_many_jobs(e: QueueFullError) -> HTTPException:
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+
+
+def submit_job(upload: Upload, options: VideoOptions):
+    try:
+        return job_manager.submit(upload.path, upload.fields["api_key"], upload.fields["model"], options,
+                                  upload.sha256)
+    except QueueFullError as e:
+        raise too_many_jobs(e)
+
+
+def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
 cnt = 0
 # image_path = 'imgs/google_page.png'
 # image_path = 'imgs/windows_home.png'
@@ -80,24 +263,128 @@ image_path = ""
 #         "content_list": json.dumps(parsed_content_list)
 #     }
 
-@app.post("/video-to-frames/")
-async def video_to_frames(file: UploadFile = File(...), api_key: str = Form(...), model: str = Form(...)):
-    print("Received video file")
+@app.post("/video-to-frames/", openapi_extra=VIDEO_FORM)
+async def video_to_frames(request: Request):
+    upload, options = await receive_video(request)
+    job = submit_job(upload, options)
+    try:
+        await asyncio.wait({job.task})
+    except asyncio.CancelledError:
+        # The client went away, stop working on its video
+        job_manager.cancel(job.id)
+        raise
+    finally:
+        job_manager.forget(job.id)
+
+    if job.status == "failed":
+        raise HTTPException(status_code=job.error_status, detail=job.error)
+    if job.status == "cancelled":
+        raise HTTPException(status_code=410, detail="Job was cancelled")
+    return job.result
+
+
+class JobStreamResponse(StreamingResponse):
+    """
+    NDJSON events of a streamed job. The job is closed once the response
+    is over, including when the client went away before the first event.
+    """
+
+    def __init__(self, job, events):
+        self.job = job
+        self.events = events
+        super().__init__(self.lines(), media_type="application/x-ndjson")
+
+    async def lines(self):
+        yield json.dumps({"type": "job", "id": self.job.id}) + "\n"
+        async for event in self.events:
+            yield json.dumps(event) + "\n"
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await job_manager.close_stream(self.job, self.events)
+            job_manager.forget(self.job.id)
+
+
+@app.post("/video-to-frames/stream", openapi_extra=VIDEO_FORM)
+async def video_to_frames_stream(request: Request):
+    """
+    Streaming variant of /video-to-frames/: the response is NDJSON, one
+    event per line (job, progress, keyframe, analyzing, analysis, done or
+    error), sent as soon as each is available.
+    """
+    upload, options = await receive_video(request)
+    try:
+        job, events = job_manager.stream(upload.path, upload.fields["api_key"], upload.fields["model"], options,
+                                         upload.sha256)
+    except QueueFullError as e:
+        raise too_many_jobs(e)
+
+    return JobStreamResponse(job, events)
+
+
+@app.post("/jobs/", status_code=202, openapi_extra=VIDEO_FORM)
+async def create_job(request: Request):
+    upload, options = await receive_video(request)
+    job = submit_job(upload, options)
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    return get_job(job_id).to_dict()
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = get_job(job_id)
+    if job.status == "done":
+        return job.result
+    if job.status == "failed":
+        raise HTTPException(status_code=job.error_status, detail=job.error)
+    if job.status == "cancelled":
+        raise HTTPException(status_code=410, detail="Job was cancelled")
+    return JSONResponse(status_code=202, content=job.to_dict())
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    get_job(job_id)
+    return job_manager.cancel(job_id).to_dict()
+
+
+@app.get("/frames/{frame_id}")
+async def get_frame(frame_id: str, request: Request):
+    path = frame_store.path(frame_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Frame not found")
+    # Frames are named after their content, so they never change
+    etag = f'"{frame_id.split(".")[0]}"'
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={FRAME_TTL}, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=MIME_TYPES[os.path.splitext(frame_id)[1]], headers=headers)
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {
+        "keyframes": job_manager.keyframe_cache.stats(),
+        "analysis": job_manager.analysis_cache.stats(),
+        "frames": await asyncio.to_thread(frame_store.stats),
+    }
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
 
-    # Read video file into bytes
-    video_data = await file.read()
 
-    # Use a temporary file to store the video
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as temp_file:
-        temp_file.write(video_data)
-        temp_file_path = temp_file.name
-    
-    print("Read video file into bytes")
-    frames = process_video(temp_file_path)
-    output = analyze_video(frames, api_key, model)
+@app.get("/llm/stats")
+async def llm_stats():
+    return llm_client.stats.to_dict()
 
-    return {"frames": frames, "output": output.choices[0].message.content}
-    
 
 @app.get("/")
 async def root():
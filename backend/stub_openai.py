@@ -0,0 +1,118 @@
+"""
+Local stand-in for the OpenAI chat completions API, so the video pipeline
+can be run and measured without network access or an API key:
+
+    python stub_openai.py --port 8001 --latency 0.5 --fail-every 3
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 python server.py
+
+It answers every request with one step per image sent, in the shape of
+analyze_video_schema, and supports streaming.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def create_app(latency=0.0, fail_every=0, fail_status=429):
+    """
+    latency: seconds to wait before answering.
+    fail_every: fail every n-th request with fail_status (0 never fails).
+    """
+    app = FastAPI()
+    counter = itertools.count(1)
+    app.state.requests = []
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        number = next(counter)
+        app.state.requests.append(body)
+        await asyncio.sleep(latency)
+
+        if fail_every and number % fail_every == 0:
+            return JSONResponse(status_code=fail_status, headers={"retry-after": "0"},
+                                content={"error": {"message": "Injected failure", "type": "stub_error"}})
+
+        images = [part for message in body["messages"] if isinstance(message["content"], list)
+                  for part in message["content"] if part.get("type") == "image_url"]
+        content = json.dumps({"steps": [
+            {
+                "state_description": f"Screen {index + 1} of the recording.",
+                "action": "left_click",
+                "outcome": f"The application moves on to screen {index + 2}.",
+            }
+            for index in range(len(images))
+        ]})
+        usage = {
+            # Rough figures, a low detail image costs 85 tokens
+            "prompt_tokens": 85 * len(images) + len(json.dumps(body["messages"][0])) // 4,
+            "completion_tokens": len(content) // 4,
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-stub-{number}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": body["model"],
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                    "logprobs": None,
+                }],
+                "usage": usage,
+            }
+
+        def chunk(choices, chunk_usage=None):
+            return "data: " + json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": body["model"],
+                "choices": choices,
+                "usage": chunk_usage,
+            }) + "\n\n"
+
+        async def events():
+            for start in range(0, len(content), 64):
+                yield chunk([{"index": 0, "delta": {"content": content[start:start + 64]}, "finish_reason": None}])
+            yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield chunk([], usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def serve_in_background(app, port=0, host="127.0.0.1"):
+    """Run an app on a background thread; returns the server and its base URL."""
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, f"http://{host}:{port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--fail-every", type=int, default=0)
+    parser.add_argument("--fail-status", type=int, default=429)
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.latency, args.fail_every, args.fail_status), host=args.host, port=args.port)
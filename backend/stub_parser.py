@@ -0,0 +1,105 @@
+"""
+Local stand-in for the screen parser service, so AutomationSystem and
+parser_client.py can be run and measured without it:
+
+    python stub_parser.py --port 8002 --latency 0.2 --fail-every 3
+    PARSER_URL=http://127.0.0.1:8002 PARSER_PROTOCOL=binary python replicate.py
+
+Elements are the bounding boxes of the high-contrast regions of the
+screenshot, found with OpenCV instead of a detection model; the annotated
+image has every box drawn with its id. Both the binary protocol and the
+legacy base64 JSON endpoint are served.
+"""
+import argparse
+import asyncio
+import base64
+import json
+
+import cv2
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, File, HTTPException, Request, UploadFile
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel
+
+from parser_client import RESULT_HEADER
+
+
+def find_elements(image, min_area=150):
+    """Bounding boxes [x, y, width, height] of the distinct regions of a BGR image, top to bottom."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    edges = cv2.Canny(gray, 50, 150)
+    # Merge the letters of a word, and the parts of a widget, into one region
+    edges = cv2.dilate(edges, cv2.getStructuringElement(cv2.MORPH_RECT, (9, 5)))
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = [list(cv2.boundingRect(contour)) for contour in contours]
+    boxes = [box for box in boxes if box[2] * box[3] >= min_area]
+    return sorted(boxes, key=lambda box: (box[1], box[0]))
+
+
+def annotate(image, boxes):
+    annotated = image.copy()
+    for element_id, (x, y, w, h) in enumerate(boxes):
+        cv2.rectangle(annotated, (x, y), (x + w, y + h), (0, 0, 255), 2)
+        cv2.putText(annotated, str(element_id), (x, max(12, y - 3)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
+    ret, buffer = cv2.imencode(".png", annotated)
+    return buffer.tobytes()
+
+
+def parse_image(data):
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise HTTPException(status_code=400, detail="Could not decode image")
+    boxes = find_elements(image)
+    coords = {str(element_id): box for element_id, box in enumerate(boxes)}
+    content_list = [f"Element {element_id}: {w}x{h} region" for element_id, (_, _, w, h) in enumerate(boxes)]
+    return annotate(image, boxes), coords, content_list
+
+
+class ImageData(BaseModel):
+    image: str
+
+
+def create_app(latency=0.0, fail_every=0, fail_status=503):
+    """
+    latency: seconds to wait before answering a parse.
+    fail_every: fail every n-th parse with fail_status (0 never fails).
+    """
+    app = FastAPI()
+    app.state.requests = 0
+
+    @app.middleware("http")
+    async def inject_failures(request: Request, call_next):
+        app.state.requests += 1
+        await asyncio.sleep(latency)
+        if fail_every and app.state.requests % fail_every == 0:
+            return JSONResponse(status_code=fail_status, content={"detail": "Injected failure"})
+        return await call_next(request)
+
+    @app.post("/parse")
+    async def parse(image: UploadFile = File(...)):
+        annotated, coords, content_list = parse_image(await image.read())
+        result = json.dumps({"coords": coords, "content_list": content_list})
+        return Response(annotated, media_type="image/png", headers={RESULT_HEADER: result})
+
+    @app.post("/file")
+    async def parse_legacy(file: ImageData):
+        annotated, coords, content_list = parse_image(base64.b64decode(file.image))
+        return {
+            "photo": base64.b64encode(annotated).decode(),
+            "coords": json.dumps(coords),
+            "content_list": json.dumps(content_list),
+        }
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--fail-every", type=int, default=0)
+    parser.add_argument("--fail-status", type=int, default=503)
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.latency, args.fail_every, args.fail_status), host=args.host, port=args.port)
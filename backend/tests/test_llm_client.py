@@ -0,0 +1,81 @@
+import asyncio
+
+import openai
+import pytest
+
+import llm_client
+import stub_openai
+
+REQUEST = {"model": "gpt-4o", "messages": [{"role": "user", "content": "Describe the recording."}]}
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """Serve a stub_openai app and point llm_client at it, with fresh stats."""
+    servers = []
+
+    def serve(**options):
+        app = stub_openai.create_app(**options)
+        app.state.in_flight = 0
+        app.state.max_in_flight = 0
+
+        @app.middleware("http")
+        async def count_in_flight(request, call_next):
+            app.state.in_flight += 1
+            app.state.max_in_flight = max(app.state.max_in_flight, app.state.in_flight)
+            try:
+                return await call_next(request)
+            finally:
+                app.state.in_flight -= 1
+
+        server, url = stub_openai.serve_in_background(app)
+        servers.append(server)
+        monkeypatch.setattr(llm_client, "LLM_BASE_URL", url + "/v1")
+        return app
+
+    monkeypatch.setattr(llm_client, "stats", llm_client.LLMStats())
+    yield serve
+    for server in servers:
+        server.should_exit = True
+
+
+async def complete(count):
+    try:
+        return await asyncio.gather(*[llm_client.chat_completion_async("key", **REQUEST) for _ in range(count)])
+    finally:
+        await llm_client.async_clients.close()
+
+
+def test_rate_limited_calls_are_retried(stub):
+    app = stub(fail_every=2)
+
+    responses = asyncio.run(complete(3))
+
+    assert all(response.choices[0].finish_reason == "stop" for response in responses)
+    # Requests 2, 4 and so on were answered with a 429
+    assert len(app.state.requests) > 3
+    assert llm_client.stats.retries == len(app.state.requests) - 3
+    assert llm_client.stats.calls == 3
+    assert llm_client.stats.errors == 0
+
+
+def test_retries_give_up_after_max_retries(stub, monkeypatch):
+    app = stub(fail_every=1)
+    monkeypatch.setattr(llm_client, "LLM_MAX_RETRIES", 2)
+
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(complete(1))
+
+    assert len(app.state.requests) == 3
+    assert llm_client.stats.retries == 2
+    assert llm_client.stats.errors == 1
+
+
+def test_concurrency_is_bounded_per_key(stub, monkeypatch):
+    app = stub(latency=0.1)
+    monkeypatch.setattr(llm_client, "LLM_CONCURRENCY_PER_KEY", 2)
+
+    asyncio.run(complete(6))
+
+    assert app.state.max_in_flight == 2
+    assert llm_client.stats.calls == 6
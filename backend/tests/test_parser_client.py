@@ -0,0 +1,88 @@
+import cv2
+import numpy as np
+import pytest
+
+import parser_client
+import stub_openai
+import stub_parser
+
+
+@pytest.fixture
+def stub():
+    """Serve a stub_parser app; returns it and its base URL."""
+    servers = []
+
+    def serve(**options):
+        app = stub_parser.create_app(**options)
+        server, url = stub_openai.serve_in_background(app)
+        servers.append(server)
+        return app, url
+
+    yield serve
+    for server in servers:
+        server.should_exit = True
+
+
+def screenshot():
+    image = np.full((240, 320, 3), 255, np.uint8)
+    cv2.rectangle(image, (20, 30), (140, 70), (0, 0, 0), -1)
+    cv2.putText(image, "Submit", (180, 200), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 2)
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+@pytest.mark.parametrize("protocol", ["binary", "json"])
+def test_protocols_round_trip(stub, protocol):
+    app, url = stub()
+    client = parser_client.ParserClient(url, protocol)
+
+    parsed = client.parse(screenshot(), "image/png")
+    client.close()
+
+    assert app.state.requests == 1
+    assert parsed.media_type == "image/png"
+    assert cv2.imdecode(np.frombuffer(parsed.image, np.uint8), cv2.IMREAD_COLOR).shape == (240, 320, 3)
+    assert len(parsed.coords) == len(parsed.content_list) == 2
+    # The filled rectangle, grown by the dilation that merges the parts of a widget
+    x, y, w, h = parsed.coords["0"]
+    assert x <= 20 and y <= 30 and x + w >= 141 and y + h >= 71
+
+
+def test_server_errors_are_retried(stub):
+    app, url = stub(fail_every=2)
+    client = parser_client.ParserClient(url, "binary", retries=2)
+
+    for _ in range(2):
+        assert client.parse(screenshot(), "image/png").coords
+    client.close()
+
+    # The second request was answered with a 503 and sent again
+    assert app.state.requests == 3
+
+
+def test_server_errors_give_up_after_retries(stub):
+    app, url = stub(fail_every=1)
+    client = parser_client.ParserClient(url, "json", retries=2)
+
+    with pytest.raises(parser_client.requests.HTTPError):
+        client.parse(screenshot(), "image/png")
+    client.close()
+
+    assert app.state.requests == 3
+
+
+@pytest.mark.parametrize("value", [
+    [[0, 0, 10, 10]],
+    {"0": [0, 0, 10]},
+    {"0": [0, 0, 10, "10"]},
+    {"0": None},
+    "{'0': [0, 0, 10, 10], '1': [0, 0, 10]}",
+    "__import__('os').system('true')",
+    "{'0': [0, 0, 10, 10 + 1]}",
+])
+def test_parse_coords_rejects_malformed_boxes(value):
+    with pytest.raises(ValueError):
+        parser_client.parse_coords(value)
+
+
+def test_parse_coords_reads_repr_strings():
+    assert parser_client.parse_coords("{0: [1, 2, 3.5, 4]}") == {"0": [1, 2, 3.5, 4]}
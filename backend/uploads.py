@@ -0,0 +1,129 @@
+"""
+Multipart video uploads, written to disk as the request body arrives.
+
+FastAPI's File/Form parameters have Starlette spool the whole body to a
+temporary file before the endpoint runs: the size of an upload without a
+Content-Length could only be checked once it was all received, and the
+video was then copied once more. receive_upload parses the body itself,
+writes the file part straight to its own temporary file, hashing it on the
+way, and stops reading as soon as the upload is over its limit.
+"""
+import hashlib
+import os
+import tempfile
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from fastapi import HTTPException, Request
+from python_multipart.multipart import MultipartParseError, MultipartParser, parse_options_header
+
+from utils import remove_file
+
+
+@dataclass
+class Upload:
+    path: Optional[str] = None  # Temporary file with the uploaded file, the caller must remove it
+    filename: str = ""
+    sha256: str = ""
+    size: int = 0
+    fields: Dict[str, str] = field(default_factory=dict)  # The other form fields
+
+
+class UploadParser:
+    """python-multipart callbacks writing one file field to disk and keeping the other fields."""
+
+    def __init__(self, file_field: str, max_bytes: int, max_field_bytes: int):
+        self.file_field = file_field
+        self.max_bytes = max_bytes
+        self.max_field_bytes = max_field_bytes
+        self.upload = Upload()
+        self.file = None
+        self.digest = hashlib.sha256()
+        self.field_bytes = 0
+        self.header_name = b""
+        self.header_value = b""
+        self.disposition = b""
+        self.name = None
+        self.value = None  # bytearray of a field part, None while receiving the file
+
+    def on_part_begin(self):
+        self.disposition = b""
+        self.name = None
+        self.value = bytearray()
+
+    def on_header_field(self, data, start, end):
+        self.header_name += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        if self.header_name.lower() == b"content-disposition":
+            self.disposition = self.header_value
+        self.header_name = self.header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.disposition)
+        self.name = options.get(b"name", b"").decode("utf-8", "replace")
+        if self.name == self.file_field and b"filename" in options:
+            if self.file is not None:
+                raise HTTPException(status_code=400, detail=f"Only one {self.file_field} can be uploaded")
+            self.upload.filename = options[b"filename"].decode("utf-8", "replace")
+            suffix = os.path.splitext(self.upload.filename)[1] or ".mp4"
+            self.file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
+            self.upload.path = self.file.name
+            self.value = None
+
+    def on_part_data(self, data, start, end):
+        chunk = data[start:end]
+        if self.value is not None:
+            self.field_bytes += len(chunk)
+            if self.field_bytes > self.max_field_bytes:
+                raise HTTPException(status_code=413, detail="Form fields too large")
+            self.value += chunk
+            return
+        self.upload.size += len(chunk)
+        if self.upload.size > self.max_bytes:
+            raise HTTPException(status_code=413, detail="Upload too large")
+        self.digest.update(chunk)
+        self.file.write(chunk)
+
+    def on_part_end(self):
+        if self.value is not None:
+            self.upload.fields[self.name] = self.value.decode("utf-8", "replace")
+        else:
+            self.file.close()
+            self.upload.sha256 = self.digest.hexdigest()
+
+    def callbacks(self):
+        return {name: getattr(self, name) for name in (
+            "on_part_begin", "on_header_field", "on_header_value", "on_header_end", "on_headers_finished",
+            "on_part_data", "on_part_end")}
+
+
+async def receive_upload(request: Request, max_bytes: int, max_field_bytes: int, file_field: str = "file") -> Upload:
+    """
+    Parse a multipart/form-data body with one file in file_field, as it
+    is received. Uploads over max_bytes, or with more than max_field_bytes
+    of other fields, are rejected with a 413 without reading further.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data body")
+
+    parser = UploadParser(file_field, max_bytes, max_field_bytes)
+    multipart = MultipartParser(params[b"boundary"], parser.callbacks())
+    try:
+        async for chunk in request.stream():
+            multipart.write(chunk)
+        multipart.finalize()
+        if parser.upload.path is None or not parser.file.closed:
+            raise HTTPException(status_code=422, detail=f"{file_field} is required")
+    except BaseException as e:
+        if parser.file is not None:
+            parser.file.close()
+            remove_file(parser.file.name)
+        if isinstance(e, MultipartParseError):
+            raise HTTPException(status_code=400, detail="Malformed multipart body")
+        raise
+    return parser.upload
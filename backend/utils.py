@@ -1,141 +1,670 @@
-from openai import OpenAI
+import os
 import cv2
 import base64
-from io import BytesIO
-from PIL import Image
-import numpy as np
 import json
+import asyncio
+import difflib
+import re
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+import dataclasses
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+import llm_client
+from dedup import KEEP_POLICIES, KeyframeIndex, dhash
+from frame_store import FrameStore, frame_url
+from noise_mask import NoiseMask
 from prompts import analyze_video_prompt, analyze_video_schema
 
+# Image tokens per analysis request; longer keyframe sequences are split into windows
+WINDOW_TOKEN_BUDGET = int(os.environ.get("WINDOW_TOKEN_BUDGET", "16000"))
+# Keyframes shared by consecutive windows, so no transition is lost between them
+WINDOW_OVERLAP = int(os.environ.get("WINDOW_OVERLAP", "1"))
+
 # Helper function to calculate Mean Squared Error (MSE) between two images
 
 
 def mse(img1, img2):
-    h, w, _ = img1.shape
-    diff = cv2.subtract(img1, img2)
-    err = np.sum(diff**2)
-    mse = err/(float(h*w))
-    return mse
+    # NORM_L2SQR accumulates in float64, squaring the uint8 difference would wrap around
+    h, w = img1.shape[:2]
+    return cv2.norm(img1, img2, cv2.NORM_L2SQR) / float(h*w)
+
+
+def reduce_frame(frame, width):
+    """
+    Grayscale copy of a BGR frame, halved with a Gaussian pyramid until it
+    is at most 'width' pixels wide.
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    while width and gray.shape[1] > width:
+        gray = cv2.pyrDown(gray)
+    return gray
+
+
+def changed_area(prev_gray, gray, threshold, min_area=0, mask=None):
+    """
+    Area in pixels of the largest connected region that changed by more
+    than 'threshold' between two grayscale images, leaving out the zero
+    pixels of mask. Returns 0 early when fewer than min_area pixels
+    changed in total.
+    """
+    diff = cv2.absdiff(prev_gray, gray)
+    _, thresh = cv2.threshold(diff, threshold, 255, cv2.THRESH_BINARY)
+    if mask is not None:
+        thresh = cv2.bitwise_and(thresh, mask)
+    if cv2.countNonZero(thresh) <= min_area:
+        return 0
+    count, _, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8)
+    if count <= 1:
+        return 0
+    # Label 0 is the unchanged background
+    return int(stats[1:, cv2.CC_STAT_AREA].max())
+
+
+def same_screen(seen_gray, gray, threshold, max_pixels, mask=None):
+    """Whether at most max_pixels pixels differ by more than 'threshold' between two reduced samples."""
+    if seen_gray.shape != gray.shape:
+        return False
+    _, thresh = cv2.threshold(cv2.absdiff(seen_gray, gray), threshold, 255, cv2.THRESH_BINARY)
+    if mask is not None:
+        thresh = cv2.bitwise_and(thresh, mask)
+    return cv2.countNonZero(thresh) <= max_pixels
+
+
+def changed_regions(prev_gray, gray, threshold, min_area=0, join=5):
+    """
+    Bounding boxes (x, y, width, height) of the regions of more than
+    min_area pixels that changed by more than 'threshold' between two
+    grayscale images of the same size. Changes less than 'join' pixels
+    apart, like the letters of a word, form one region.
+    """
+    diff = cv2.absdiff(prev_gray, gray)
+    _, thresh = cv2.threshold(diff, threshold, 255, cv2.THRESH_BINARY)
+    if not cv2.countNonZero(thresh):
+        return []
+    if join > 1:
+        thresh = cv2.dilate(thresh, cv2.getStructuringElement(cv2.MORPH_RECT, (join, join)))
+    count, _, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8)
+    return [tuple(int(v) for v in stats[label, :4]) for label in range(1, count)
+            if stats[label, cv2.CC_STAT_AREA] > min_area]
+
+
+@dataclass
+class VideoOptions:
+    threshold: int = 70  # Difference threshold to detect state change
+    min_diff_area: int = 500  # Minimum area of change to be considered relevant
+    # Frames analyzed per second of video. None samples every frame_skip-th frame like before, whatever the FPS:
+    # 2/s on 30 fps recordings but 4/s on 60 fps ones, where a rate of 2 would halve the temporal resolution
+    sample_rate: Optional[float] = None
+    frame_skip: int = 15  # Stride when no sample_rate is set or the container reports no FPS
+    seek: bool = False  # Seek between samples instead of grabbing every frame
+    # Sample static stretches less often and bisect every change down to its first frame. Only faster with
+    # seek, grabbing decodes every frame anyway; ignored when workers > 1
+    adaptive: bool = False
+    max_idle_seconds: float = 2.0  # Longest gap between two samples of a static stretch, when adaptive
+    workers: int = 1  # Processes decoding separate time ranges of one video
+    min_segment_seconds: float = 60  # Shortest time range worth its own process
+    detect_width: int = 640  # Frames are compared at most this wide; 0 compares full resolution
+    roi: Optional[Tuple[int, int, int, int]] = None  # (x, y, width, height) of the only region compared, in pixels
+    mask_regions: Optional[List[Tuple[int, int, int, int]]] = None  # (x, y, width, height) regions never compared
+    # Samples to learn the pixels that keep changing from, to ignore them; 0 disables. Opt-in: a menu opened and
+    # closed a few times while learning is masked for the rest of the video
+    flicker_samples: int = 0
+    codec: str = "jpeg"  # Keyframe encoding: png, jpeg or webp
+    quality: int = 90  # JPEG/WebP quality, ignored for PNG
+    max_width: int = 1920  # Keyframes are downscaled to fit in max_width x max_height; 0 keeps the size
+    max_height: int = 1080
+    save_dir: Optional[str] = None  # Also write the encoded keyframes to this directory
+    frame_store: Optional[FrameStore] = None  # Spool keyframes to this store instead of keeping them in memory
+    min_mse: float = 0.05  # Minimum MSE between a keyframe and the one kept before it
+    dedup: str = "revisit"  # Keyframes of a screen seen before: all, first or revisit (see dedup.KEEP_POLICIES)
+    dedup_distance: int = 4  # Max differing bits of two 64 bit dHashes of the same screen
+    # Max full resolution pixels differing by more than threshold between a revisit and the screen it matches
+    revisit_max_pixels: int = 50
+
+    def stride(self, fps):
+        if fps and fps > 0 and self.sample_rate:
+            return max(1, round(fps / self.sample_rate))
+        return self.frame_skip
+
+    def max_stride(self, fps):
+        if fps and fps > 0:
+            return max(self.stride(fps), round(fps * self.max_idle_seconds))
+        return self.frame_skip * 4
+
+
+@dataclass
+class Keyframe:
+    frame_index: int
+    data: bytes  # Encoded image
+    mime_type: str
+    encode_time: float  # Seconds spent resizing and encoding
+    width: int = 0  # Size of the encoded image
+    height: int = 0
+    duplicate_of: Optional[int] = None  # Position of the earlier keyframe showing the same screen; data is then empty
+    size: int = 0  # Bytes of the encoded image, wherever it is kept
+    frame_id: Optional[str] = None  # Id of the image in 'store'; data is then empty
+    store: Optional[FrameStore] = None
+
+    def __post_init__(self):
+        self.size = self.size or len(self.data)
+
+    def spool(self, store, extension):
+        """Move the image to a frame store, so only its id stays in memory."""
+        self.frame_id = store.put(self.data, extension)
+        self.store = store
+        self.data = b""
+
+    def image(self):
+        return self.store.read(self.frame_id) if self.frame_id else self.data
+
+    def base64(self):
+        return base64.b64encode(self.image()).decode('utf-8')
+
+    def data_url(self):
+        return f"data:{self.mime_type};base64,{self.base64()}"
+
+
+@dataclass
+class ScanStats:
+    """Counts and stage timings of one video scan, recorded by metrics.record_scan."""
+    frames_scanned: int = 0  # Samples compared for changes
+    frames_changed: int = 0  # Samples with a relevant change
+    frames_suppressed: int = 0  # Samples whose only relevant change was in masked pixels
+    keyframes: int = 0  # Revisited screens included
+    duplicates: int = 0
+    encoded_bytes: int = 0
+    decode_seconds: float = 0.0  # Reading and grabbing frames
+    detect_seconds: float = 0.0  # Reducing and comparing samples
+    encode_seconds: float = 0.0  # Resizing and encoding keyframes
+
+    def merge(self, other):
+        for name in self.__dataclass_fields__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+
+CODECS = {
+    # codec: (extension, mime type, quality flag)
+    "png": (".png", "image/png", None),
+    "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+
+
+def encode_frame(frame, options):
+    """
+    Resize a BGR frame to the configured maximum size and encode it straight
+    from the OpenCV buffer. Returns the encoded bytes, their mime type and
+    the (width, height) of the encoded image.
+    """
+    if options.codec not in CODECS:
+        raise ValueError(f"Unsupported codec: {options.codec}")
+    extension, mime_type, quality_flag = CODECS[options.codec]
+
+    h, w = frame.shape[:2]
+    scale = min(options.max_width / w if options.max_width else 1,
+                options.max_height / h if options.max_height else 1)
+    if scale < 1:
+        frame = cv2.resize(frame, (max(1, round(w * scale)), max(1, round(h * scale))),
+                           interpolation=cv2.INTER_AREA)
+
+    params = [quality_flag, options.quality] if quality_flag is not None else []
+    ret, buffer = cv2.imencode(extension, frame, params)
+    if not ret:
+        raise ValueError(f"Could not encode frame as {options.codec}.")
+    return buffer.tobytes(), mime_type, (frame.shape[1], frame.shape[0])
+
+
+def sample_frames(cap, stride, position=0, end=None, seek=False):
+    """
+    Yield (frame_index, frame) for every frame whose index is a multiple of
+    stride, starting at position (the index of the next frame in cap).
+    Frames in between are only grabbed, never decoded into a BGR image,
+    or skipped entirely with a seek when seek is set.
+    """
+    while end is None or position < end:
+        if position % stride == 0:
+            ret, frame = cap.read()
+            if not ret:
+                return
+            yield position, frame
+        elif seek:
+            position = (position // stride + 1) * stride
+            cap.set(cv2.CAP_PROP_POS_FRAMES, position)
+            continue
+        elif not cap.grab():
+            return
+        position += 1
+
+
+class AdaptiveStride:
+    """
+    Sampling stride that doubles with every sample showing no change, up
+    to max_stride, and falls back to the base stride after a change.
+    """
+
+    def __init__(self, stride, max_stride):
+        self.base = stride
+        self.max = max(stride, max_stride)
+        self.current = stride
+
+    def update(self, changed):
+        self.current = self.base if changed else min(self.current * 2, self.max)
+
+
+class FrameReader:
+    """
+    Random access to the frames of a capture. A seek costs about as much
+    as decoding SEEK_FRAMES frames, so short jumps forward are grabbed
+    instead; without seek, every jump forward is.
+    """
+    SEEK_FRAMES = 24
+
+    def __init__(self, cap, position=0, seek=True):
+        self.cap = cap
+        self.position = position  # Index of the next frame in cap
+        self.seek = seek
+
+    def read(self, index):
+        """The BGR frame at index, or None past the end of the video."""
+        if index < self.position or (self.seek and index >= self.position + self.SEEK_FRAMES):
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+            self.position = index
+        while self.position < index:
+            if not self.cap.grab():
+                return None
+            self.position += 1
+        ret, frame = self.cap.read()
+        self.position += 1
+        return frame if ret else None
+
+    def release(self):
+        self.cap.release()
+
+
+def adaptive_frames(reader, strides, previous, end=None):
+    """
+    Yield (frame_index, frame) for samples strides.current frames apart,
+    starting after the sample at 'previous'. The range [start, end) that
+    follows is compared against its base stride sample before end, so
+    that sample is always taken.
+    """
+    while True:
+        target = previous + strides.current
+        if end is not None:
+            boundary = end - strides.base
+            if previous < boundary < target:
+                target = boundary
+            elif target >= end:
+                return
+        frame = reader.read(target)
+        if frame is None:
+            return
+        yield target, frame
+        previous = target
+
+
+def roi_box(options, frame):
+    """(x, y, width, height) of the region of a frame compared for changes, within the frame."""
+    height, width = frame.shape[:2]
+    x, y, w, h = options.roi or (0, 0, width, height)
+    x0, y0 = min(max(0, x), width), min(max(0, y), height)
+    return x0, y0, min(width, x + w) - x0, min(height, y + h) - y0
+
+
+def sample_gray(frame, options):
+    """Reduced grayscale copy of the region of a frame compared for changes."""
+    if options.roi:
+        x, y, w, h = roi_box(options, frame)
+        if w <= 0 or h <= 0:
+            raise ValueError(f"Region of interest {options.roi} is outside the video.")
+        frame = frame[y:y + h, x:x + w]
+    return reduce_frame(frame, options.detect_width)
+
+
+def noise_mask(options, frame, gray):
+    """The NoiseMask of a video's samples, or None when nothing is masked."""
+    if not (options.mask_regions or options.flicker_samples):
+        return None
+    x, y, w, _ = roi_box(options, frame)
+    return NoiseMask(gray.shape, gray.shape[1] / w, (x, y), options.mask_regions, options.flicker_samples,
+                     options.threshold)
+
+
+def find_transition(reader, options, first, last, prev_gray, min_area, stats, mask=None):
+    """
+    Bisect the frames between the samples 'first' (unchanged) and 'last'
+    (changed) for the earliest one that differs from prev_gray, the reduced
+    sample at 'first'. Returns (frame_index, frame, gray) of the earliest
+    changed frame before 'last', or None when 'last' is the first one.
+    """
+    found = None
+    while last - first > 1:
+        middle = (first + last) // 2
+        frame = reader.read(middle)
+        if frame is None:
+            break
+        gray = sample_gray(frame, options)
+        stats.frames_scanned += 1
+        if changed_area(prev_gray, gray, options.threshold, min_area, mask) > min_area:
+            last, found = middle, (middle, frame, gray)
+        else:
+            first = middle
+    return found
 
 
-def process_video(video_path):
+def open_video(video_path):
     # Initialize video capture object
     cap = cv2.VideoCapture(video_path)
 
     # Check if video opened successfully
     if not cap.isOpened():
-        print("Error: Could not open video.")
-        exit()
-
-    # Read the first frame from the video
-    ret, prev_frame = cap.read()
-    if not ret:
-        print("Error: Could not read the first frame.")
-        cap.release()
-        exit()
-
-    # Convert the first frame to grayscale
-    prev_gray = cv2.cvtColor(prev_frame, cv2.COLOR_BGR2GRAY)
-
-    # Parameters
-    THRESHOLD = 70  # Difference threshold to detect state change
-    MIN_DIFF_AREA = 500  # Minimum area of change to be considered relevant
-    FRAME_SKIP = 15  # Skip a certain number of frames to make the process faster
-
-    frame_count = 0  # Initialize frame counter for skipping frames
-    previous_frame = None
-    previous_mse = 0  # Track previous MSE
-    base64_images = []  # Array to store base64-encoded images
-
-    while True:
-        # Read the next frame from the video
-        ret, frame = cap.read()
+        raise ValueError("Could not open video.")
+    return cap
+
+
+def iter_changes(video_path, options, stride, start, end=None, stats=None, max_stride=None):
+    """
+    Yield (frame_index, frame, gray) for every sample in [start, end) that differs
+    enough from the sample before it, and (frame_index, None, None) for the
+    other samples. start must be a multiple of stride; the sample before it
+    is read as well, so a segment starting mid-video still sees the change
+    at its first sample. Decode and detection times are added to stats.
+
+    With options.adaptive, the stride grows up to max_stride while nothing
+    changes, and a change is reported at the first frame showing it, found
+    by bisecting the frames since the previous sample.
+
+    Only options.roi is compared, without options.mask_regions and the
+    pixels found flickering over the first options.flicker_samples samples
+    (of this range, when the video is split). Samples that only changed
+    there are counted in stats.frames_suppressed.
+    """
+    stats = stats if stats is not None else ScanStats()
+    cap = open_video(video_path)
+    probe = None  # Second reader for bisection, so cap keeps reading forward
+    try:
+        clock = time.perf_counter()
+        # Read the sample preceding the range (the first frame for start == stride)
+        position = start - stride
+        if position > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, position)
+        ret, prev_frame = cap.read()
         if not ret:
-            print("End of video reached.")
-            break
-
-        frame_count += 1
-
-        # Process every 'FRAME_SKIP' frame (to speed up the process)
-        if frame_count % FRAME_SKIP != 0:
-            continue
-
-        # Convert the current frame to grayscale
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-        # Compute the absolute difference between the current and previous frame
-        diff = cv2.absdiff(prev_gray, gray)
-
-        # Apply a binary threshold to the difference image
-        _, thresh = cv2.threshold(diff, THRESHOLD, 255, cv2.THRESH_BINARY)
-
-        # Find contours of the difference regions
-        contours, _ = cv2.findContours(
-            thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        # Check if any significant change is detected based on contour area
-        change_detected = False
-
-        for contour in contours:
-            if cv2.contourArea(contour) > MIN_DIFF_AREA:
+            raise ValueError(f"Could not read frame {position}.")
+
+        # Frames are compared as downscaled grayscale images of the region of interest
+        prev_gray = sample_gray(prev_frame, options)
+        mask = noise_mask(options, prev_frame, prev_gray)
+
+        # MIN_DIFF_AREA is in full resolution pixels
+        scale = (prev_gray.shape[1] / roi_box(options, prev_frame)[2]) ** 2
+        min_area = options.min_diff_area * scale
+
+        if options.adaptive:
+            strides = AdaptiveStride(stride, max_stride or stride)
+            samples = adaptive_frames(FrameReader(cap, position + 1, options.seek), strides, position, end)
+        else:
+            # Only every 'stride'-th frame is decoded and analyzed
+            samples = sample_frames(cap, stride, position + 1, end, options.seek)
+
+        for frame_count, frame in samples:
+            decoded = time.perf_counter()
+            stats.decode_seconds += decoded - clock
+            gray = sample_gray(frame, options)
+            if mask is not None and mask.learning:
+                mask.learn(prev_gray, gray)
+            keep = mask.keep if mask is not None else None
+            changed = changed_area(prev_gray, gray, options.threshold, min_area, keep) > min_area
+            if not changed and keep is not None and changed_area(prev_gray, gray, options.threshold,
+                                                                 min_area) > min_area:
+                stats.frames_suppressed += 1
+            stats.detect_seconds += time.perf_counter() - decoded
+            stats.frames_scanned += 1
+
+            if changed:
                 # Significant change detected
-                change_detected = True
-                print(f"Relevant change detected at frame {frame_count}")
-
-                # Initialize current_mse to 0 if previous_frame is None
-                current_mse = 0 if previous_frame is None else mse(
-                    previous_frame, frame)
-
-                # Calculate MSE difference if a previous MSE value exists
-                mse_difference = abs(
-                    current_mse - previous_mse) if previous_frame is not None else None
-
-                # Save image locally and to Base64 list if relevant change
-                if (previous_frame is None) or (mse_difference and mse_difference > 0.05):
-                    # Save frame as an image locally
-                    filename = f'relevant_change_{frame_count}.png'
-                    cv2.imwrite(filename, frame)
-
-                    # Convert frame to Base64 and store it
-                    pil_img = Image.fromarray(
-                        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-                    buffer = BytesIO()
-                    pil_img.save(buffer, format="PNG")
-                    base64_images.append(base64.b64encode(
-                        buffer.getvalue()).decode('utf-8'))
-
-                    # Update previous_frame and previous_mse
-                    previous_frame = frame
-                    previous_mse = current_mse
-                break  # Exit the loop once a relevant change is detected
-
-        # Update the previous frame to the current frame
-        prev_gray = gray
-
-        # Exit if 'q' is pressed
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-
-    # Release video capture object
+                stats.frames_changed += 1
+                change = frame_count, frame, gray
+                if options.adaptive and frame_count - position > 1:
+                    probe = probe or FrameReader(open_video(video_path))
+                    bisected = time.perf_counter()
+                    change = find_transition(probe, options, position, frame_count, prev_gray, min_area,
+                                             stats, keep) or change
+                    stats.decode_seconds += time.perf_counter() - bisected
+                yield change
+                # The screen may have changed again before this sample (A, then B briefly, then C)
+                while change[0] != frame_count and changed_area(change[2], gray, options.threshold, min_area,
+                                                                keep) > min_area:
+                    stats.frames_changed += 1
+                    bisected = time.perf_counter()
+                    change = find_transition(probe, options, change[0], frame_count, change[2], min_area,
+                                             stats, keep) or (frame_count, frame, gray)
+                    stats.decode_seconds += time.perf_counter() - bisected
+                    yield change
+            else:
+                yield frame_count, None, None
+
+            if options.adaptive:
+                strides.update(changed)
+            # Update the previous frame to the current frame
+            prev_gray = gray
+            position = frame_count
+            # Time spent by the consumer between two samples is not ours
+            clock = time.perf_counter()
+    finally:
+        # Release video capture object
+        cap.release()
+        if probe is not None:
+            probe.release()
+
+
+def scan_segment(video_path, options, stride, start, end, max_stride=None):
+    # Only changed samples are sent back to the parent process
+    stats = ScanStats()
+    changes = [change for change in iter_changes(video_path, options, stride, start, end, stats, max_stride)
+               if change[1] is not None]
+    return changes, stats
+
+
+def split_segments(frame_count, stride, workers):
+    """
+    Split the samples of a video into at most 'workers' contiguous
+    [start, end) frame ranges, each starting on a sample. The last range
+    is open-ended since container frame counts are not always exact.
+    """
+    samples = frame_count // stride
+    workers = max(1, min(workers, samples))
+    starts = [stride * (1 + samples * i // workers) for i in range(workers)]
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def probe_video(video_path):
+    """Return the FPS and frame count reported by the container."""
+    cap = open_video(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     cap.release()
-    cv2.destroyAllWindows()
-
-    # Now, base64_images contains the Base64-encoded strings of each relevant frame
-    return base64_images
-
-
-def analyze_video(parsed_images, api_key, model):
-    client = OpenAI(api_key=api_key)
-
-    # Use map to apply the transformation to each item
-    parsed_images = list(map(lambda img: {
-        "type": "image_url",
-        "image_url": {
-            "url": f'data:image/png;base64,{img}'
-        }
-    }, parsed_images))
+    return fps, frame_count
+
+
+def iter_video_changes(video_path, options, fps, frame_count, stats):
+    if options.workers > 1 and options.adaptive:
+        # Segments cannot share the stride and last sample of the one before, so they would not find the
+        # same changes as a sequential adaptive scan
+        options = dataclasses.replace(options, adaptive=False)
+    stride = options.stride(fps)
+    max_stride = options.max_stride(fps)
+
+    # Short videos are not worth the process start-up cost
+    if options.workers <= 1 or frame_count < options.min_segment_seconds * (fps or 30) * 2:
+        yield from iter_changes(video_path, options, stride, stride, stats=stats, max_stride=max_stride)
+        return
+
+    segments = split_segments(frame_count, stride, options.workers)
+    with ProcessPoolExecutor(max_workers=len(segments)) as executor:
+        futures = [executor.submit(scan_segment, video_path, options, stride, start, end, max_stride)
+                   for start, end in segments]
+        # Segments are merged in order, the same order the sequential scan sees them in
+        for future, (_, end) in zip(futures, segments):
+            changes, segment_stats = future.result()
+            stats.merge(segment_stats)
+            yield from changes
+            yield (end or frame_count), None, None
+
+
+def iter_process_video(video_path, options=None):
+    """
+    Scan a video and yield events as they happen:
+    ("progress", (frame_index, frame_count)) after every sample and
+    ("keyframe", keyframe) for every keyframe selected, and finally
+    ("stats", ScanStats) once the whole video was scanned.
+    """
+    options = options or VideoOptions()
+    fps, total_frames = probe_video(video_path)
+
+    if options.dedup not in KEEP_POLICIES:
+        raise ValueError(f"Unknown dedup policy: {options.dedup}")
+
+    previous_frame = None  # Reduced grayscale copy of the last kept frame
+    stats = ScanStats()
+    index = KeyframeIndex(options.dedup_distance)
+    keyframes_seen = {}  # Position -> (mime type, width, height) of encoded keyframes, for revisits
+    grays_seen = {}  # Position -> PNG of the reduced sample of encoded keyframes, to confirm revisits
+    keep = None  # Pixels of the samples outside mask_regions
+
+    for frame_count, frame, gray in iter_video_changes(video_path, options, fps, total_frames, stats):
+        yield "progress", (frame_count, total_frames)
+        if frame is None:
+            continue
 
-    response = client.chat.completions.create(
+        # Encode the frame (and optionally save it locally) if it differs from the last kept one
+        if (previous_frame is None) or mse(previous_frame, gray) > options.min_mse:
+            previous_frame = gray
+
+            # Screens seen earlier in the video are not encoded again
+            frame_hash = dhash(gray)
+            duplicate_of = None
+            if options.dedup != "all":
+                x, y, w, _ = roi_box(options, frame)
+                scale = gray.shape[1] / w
+                if keep is None and options.mask_regions:
+                    keep = NoiseMask(gray.shape, scale, (x, y), options.mask_regions).keep
+                max_pixels = options.revisit_max_pixels * scale ** 2
+
+                def confirm(position):
+                    # Same layout is not same screen: text typed in a field barely changes the hash
+                    seen_gray = cv2.imdecode(grays_seen[position], cv2.IMREAD_GRAYSCALE)
+                    return same_screen(seen_gray, gray, options.threshold, max_pixels, keep)
+
+                duplicate_of = index.find(frame_hash, confirm)
+            if duplicate_of is not None:
+                stats.duplicates += 1
+                if options.dedup == "revisit":
+                    mime_type, width, height = keyframes_seen[duplicate_of]
+                    yield "keyframe", Keyframe(frame_count, b"", mime_type, 0, width, height,
+                                               duplicate_of=duplicate_of)
+                    stats.keyframes += 1
+                continue
+
+            start = time.perf_counter()
+            data, mime_type, (width, height) = encode_frame(frame, options)
+            keyframe = Keyframe(frame_count, data, mime_type, time.perf_counter() - start, width, height)
+            index.add(frame_hash, stats.keyframes)
+            keyframes_seen[stats.keyframes] = (mime_type, width, height)
+            if options.dedup != "all":
+                # Compressed, a screen of flat UI is a few kB
+                grays_seen[stats.keyframes] = cv2.imencode(".png", gray)[1]
+            stats.keyframes += 1
+            stats.encoded_bytes += len(data)
+            stats.encode_seconds += keyframe.encode_time
+
+            extension = CODECS[options.codec][0]
+            if options.save_dir:
+                with open(os.path.join(options.save_dir, f'relevant_change_{frame_count}{extension}'), 'wb') as f:
+                    f.write(data)
+            if options.frame_store:
+                keyframe.spool(options.frame_store, extension)
+
+            yield "keyframe", keyframe
+
+    yield "stats", stats
+
+
+def process_video_with_stats(video_path, options=None):
+    """The keyframes of a video and the ScanStats of finding them."""
+    keyframes = []
+    stats = None
+    for event, value in iter_process_video(video_path, options):
+        if event == "keyframe":
+            keyframes.append(value)
+        elif event == "stats":
+            stats = value
+    return keyframes, stats
+
+
+def process_video(video_path, options=None):
+    return process_video_with_stats(video_path, options)[0]
+
+
+def frames_payload(keyframes):
+    """
+    The keyframes as returned by the API, with their encoding stats.
+    Spooled keyframes are referenced by id and URL, the others are inlined
+    as base64.
+    """
+    return {
+        "frames": [None if keyframe.frame_id else keyframe.base64() for keyframe in keyframes],
+        "frame_ids": [keyframe.frame_id for keyframe in keyframes],
+        "frame_urls": [frame_url(keyframe.frame_id) if keyframe.frame_id else None for keyframe in keyframes],
+        "frame_types": [keyframe.mime_type for keyframe in keyframes],
+        # Revisited screens have no image of their own, they point to an earlier frame
+        "duplicate_of": [keyframe.duplicate_of for keyframe in keyframes],
+        "encoding": {
+            "bytes": [keyframe.size for keyframe in keyframes],
+            "encode_ms": [round(keyframe.encode_time * 1000, 2) for keyframe in keyframes],
+        },
+    }
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def analyze_video_request(keyframes, model, note=None, window=None):
+    """
+    Chat completion arguments for the keyframes of a video, or for the
+    [start, end) window of them only.
+    """
+    start, end = window or (0, len(keyframes))
+    # Captures are numbered when some of them refer back to an earlier one
+    numbered = any(keyframe.duplicate_of is not None for keyframe in keyframes[start:end])
+    parsed_images = [{"type": "text", "text": note}] if note else []
+    for position in range(start, end):
+        keyframe = keyframes[position]
+        if numbered:
+            parsed_images.append({"type": "text", "text": f"Capture {position + 1}:"})
+        if keyframe.duplicate_of is not None and keyframe.duplicate_of < start:
+            # The capture it refers to is in an earlier window, the model has not seen it
+            keyframe = keyframes[keyframe.duplicate_of]
+        if keyframe.duplicate_of is None:
+            parsed_images.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": keyframe.data_url()
+                }
+            })
+        else:
+            parsed_images.append({
+                "type": "text",
+                "text": f"The screen is back to the state shown in capture {keyframe.duplicate_of + 1}."
+            })
+
+    return dict(
         model=model,
         messages=[
             {
@@ -163,4 +692,151 @@ def analyze_video(parsed_images, api_key, model):
         }
     )
 
-    return response
+
+def image_tokens(keyframe):
+    """Vision tokens OpenAI charges for a keyframe at high detail."""
+    if keyframe.duplicate_of is not None:
+        return 20  # Sent as a short text reference
+    width, height = keyframe.width, keyframe.height
+    if not width or not height:
+        return 1105  # A 1080p frame
+    # Fit in 2048x2048, then shrink the shortest side to 768, and count 512px tiles
+    scale = min(1, 2048 / max(width, height))
+    scale *= min(1, 768 / (min(width, height) * scale))
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return 85 + 170 * tiles
+
+
+def split_windows(keyframes, token_budget, overlap):
+    """
+    Split keyframes into [start, end) windows of at most token_budget image
+    tokens (but at least one keyframe), each sharing 'overlap' keyframes
+    with the window before it.
+    """
+    def cost(position, start):
+        keyframe = keyframes[position]
+        if keyframe.duplicate_of is not None and keyframe.duplicate_of < start:
+            # Sent as the image it refers to, see analyze_video_request
+            keyframe = keyframes[keyframe.duplicate_of]
+        return image_tokens(keyframe)
+
+    windows = []
+    start = 0
+    while start < len(keyframes):
+        end, tokens = start, 0
+        while end < len(keyframes) and (end == start or tokens + cost(end, start) <= token_budget):
+            tokens += cost(end, start)
+            end += 1
+        windows.append((start, end))
+        if end == len(keyframes):
+            break
+        start = max(end - overlap, start + 1)
+    return windows
+
+
+def same_step(step, other):
+    if step["action"] != other["action"]:
+        return False
+    text = f'{step["state_description"]} {step["outcome"]}'.lower()
+    other_text = f'{other["state_description"]} {other["outcome"]}'.lower()
+    return difflib.SequenceMatcher(None, text, other_text).ratio() > 0.8
+
+
+def merge_steps(step_lists, max_overlap):
+    """
+    Concatenate the step lists of consecutive windows. Windows share
+    keyframes, so the steps at the start of a window that repeat the ones
+    at the end of the previous window are dropped.
+    """
+    merged = []
+    for steps in step_lists:
+        duplicates = 0
+        for count in range(min(max_overlap, len(merged), len(steps)), 0, -1):
+            if all(same_step(a, b) for a, b in zip(merged[-count:], steps[:count])):
+                duplicates = count
+                break
+        merged.extend(steps[duplicates:])
+    return merged
+
+
+STEPS_START = re.compile(r'"steps"\s*:\s*\[')
+STEP_SEPARATOR = re.compile(r"[\s,]*")
+
+
+def parse_steps(content):
+    """
+    Steps of a completion, or as many as parse when it was cut short: a
+    truncated completion still holds every step before the one it stopped in.
+    """
+    try:
+        return json.loads(content)["steps"]
+    except (ValueError, KeyError, TypeError):
+        pass
+    match = STEPS_START.search(content or "")
+    if not match:
+        return []
+    decoder = json.JSONDecoder()
+    steps = []
+    position = match.end()
+    while True:
+        position = STEP_SEPARATOR.match(content, position).end()
+        try:
+            step, position = decoder.raw_decode(content, position)
+        except ValueError:
+            return steps
+        if isinstance(step, dict):
+            steps.append(step)
+
+
+async def analyze_video_windowed(keyframes, api_key, model, token_budget=None, overlap=None):
+    """
+    Analyze long keyframe sequences as overlapping windows, concurrently,
+    and merge their steps. Returns the JSON output and whether every
+    completion finished normally (i.e. was not truncated). A window that
+    did not finish normally contributes the steps that could be parsed.
+    """
+    token_budget = token_budget or WINDOW_TOKEN_BUDGET
+    overlap = WINDOW_OVERLAP if overlap is None else overlap
+    windows = split_windows(keyframes, token_budget, overlap)
+    if len(windows) <= 1:
+        response = await analyze_video_async(keyframes, api_key, model)
+        choice = response.choices[0]
+        return choice.message.content, choice.finish_reason == "stop"
+
+    # Requests are built once a call can start, so only the images of the
+    # windows in flight are held in memory
+    in_flight = asyncio.Semaphore(llm_client.LLM_CONCURRENCY_PER_KEY)
+
+    async def analyze_window(index, start, end):
+        async with in_flight:
+            request = await asyncio.to_thread(
+                analyze_video_request, keyframes, model,
+                note=f"These screen captures are part {index + 1} of {len(windows)} of a longer recording.",
+                window=(start, end))
+            return await llm_client.chat_completion_async(api_key, **request)
+
+    responses = await asyncio.gather(*[analyze_window(index, start, end)
+                                       for index, (start, end) in enumerate(windows)])
+    step_lists = [parse_steps(response.choices[0].message.content) for response in responses]
+    complete = all(response.choices[0].finish_reason == "stop" for response in responses)
+    # A shared keyframe rarely yields more than one step on each side of it
+    return json.dumps({"steps": merge_steps(step_lists, overlap + 1)}), complete
+
+
+def analyze_video(keyframes, api_key, model):
+    return llm_client.chat_completion(api_key, **analyze_video_request(keyframes, model))
+
+
+async def analyze_video_async(keyframes, api_key, model):
+    # Spooled keyframes are read from disk, off the event loop
+    request = await asyncio.to_thread(analyze_video_request, keyframes, model)
+    return await llm_client.chat_completion_async(api_key, **request)
+
+
+async def analyze_video_stream(keyframes, api_key, model):
+    """Yield (content_delta, finish_reason) pairs as the completion streams in."""
+    request = await asyncio.to_thread(analyze_video_request, keyframes, model)
+    async for chunk in llm_client.chat_completion_stream(api_key, **request):
+        if chunk.choices:
+            choice = chunk.choices[0]
+            yield choice.delta.content or "", choice.finish_reason
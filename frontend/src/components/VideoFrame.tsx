@@ -4,10 +4,12 @@ import { useState, useCallback } from 'react'
 import { useDropzone } from 'react-dropzone'
 import { Loader2, Upload, Image as ImageIcon } from 'lucide-react'
 import { Button } from "@/components/ui/button"
+import { Progress } from "@/components/ui/progress"
 import { Card, CardContent, CardFooter, CardHeader, CardTitle } from "@/components/ui/card"
 import StepsAnalysisCard from './StepsAnalysisCard'
 import { DEFAULT_TEXT } from '@/types/constants'
 import { useAppContext } from '@/contexts/App'
+import { StreamEvent } from '@/types/common'
 
 
 export default function VideoFrame() {
@@ -15,6 +17,8 @@ export default function VideoFrame() {
     const [processing, setProcessing] = useState(false)
     const [content, setContent] = useState(DEFAULT_TEXT)
     const [selectedFrames, setSelectedFrames] = useState<string[]>([])
+    const [progress, setProgress] = useState(0)
+    const [stage, setStage] = useState('Selecting key frames')
     const { llmData } = useAppContext()
 
     const onDrop = useCallback((acceptedFiles: File[]) => {
@@ -38,18 +42,52 @@ export default function VideoFrame() {
         formData.append("api_key", llmData.apiKey);
         formData.append("model", llmData.model);
 
+        setSelectedFrames([])
+        setProgress(0)
+        setStage('Selecting key frames')
+
         try {
-            const response = await fetch('http://localhost:8000/video-to-frames/', {
+            // The stream endpoint sends one JSON event per line as the video is processed
+            const response = await fetch('http://localhost:8000/video-to-frames/stream', {
                 method: 'POST',
                 body: formData,
             });
 
-            if (response.ok) {
-                const data = await response.json();
-                console.log(data)
-                setSelectedFrames(data.frames)
-                const output = JSON.parse(data.output)
-                setContent(JSON.stringify(output, null, 2))
+            if (response.ok && response.body) {
+                const reader = response.body.getReader()
+                const decoder = new TextDecoder()
+                let buffer = ''
+
+                const handleEvent = (event: StreamEvent) => {
+                    if (event.type === 'progress') {
+                        setProgress(event.total ? Math.min(100, 100 * event.scanned / event.total) : 0)
+                    } else if (event.type === 'keyframe') {
+                        // Revisited screens reuse the image of their first capture, stored
+                        // frames are loaded from their URL
+                        setSelectedFrames(frames => [...frames, event.duplicate_of !== null
+                            ? frames[event.duplicate_of]
+                            : event.url
+                                ? `http://localhost:8000${event.url}`
+                                : `data:${event.frame_type};base64,${event.frame}`])
+                    } else if (event.type === 'analyzing') {
+                        setProgress(100)
+                        setStage(`Analyzing ${event.keyframes} key frames`)
+                    } else if (event.type === 'done') {
+                        const output = JSON.parse(event.output)
+                        setContent(JSON.stringify(output, null, 2))
+                    } else if (event.type === 'error') {
+                        console.log(event.detail)
+                    }
+                }
+
+                while (true) {
+                    const { done, value } = await reader.read()
+                    if (done) break
+                    buffer += decoder.decode(value, { stream: true })
+                    const lines = buffer.split('\n')
+                    buffer = lines.pop() ?? ''
+                    lines.filter(line => line.trim()).forEach(line => handleEvent(JSON.parse(line)))
+                }
             } else {
                 // setError('Failed to process video');
             }
@@ -100,18 +138,11 @@ export default function VideoFrame() {
                     </Button>
                     {processing && (
                         <div className="w-full max-w-xs space-y-4" aria-live="polite" aria-busy={processing}>
-                                    <div className="w-full h-2 bg-secondary rounded-full overflow-hidden">
-                                        <div
-                                            className="h-full bg-primary rounded-full animate-indeterminate-progress"
-                                            style={{
-                                                width: '50%',
-                                            }}
-                                        />
-                                    </div>
+                                    <Progress value={progress} />
                             <div className="flex justify-between items-center">
                                 <div className="space-y-2">
                                     <p className="text-sm font-medium">Analyzing video...</p>
-                                    <p className="text-xs text-muted-foreground">Selecting key frames</p>
+                                    <p className="text-xs text-muted-foreground">{stage}</p>
                                 </div>
                                 <div className="flex space-x-1">
                                     <div className="w-2 h-2 bg-primary rounded-full animate-pulse" style={{ animationDelay: '0ms' }}></div>
@@ -135,7 +166,7 @@ export default function VideoFrame() {
                                     <div className="relative w-full aspect-video bg-gray-100 rounded-lg overflow-hidden">
                                         <ImageIcon className="absolute inset-0 m-auto text-gray-400" size={48} />
                                         <img
-                                            src={`data:image/jpeg;base64,${frame}`}
+                                            src={frame}
                                             alt={`Selected frame`}
                                             className="absolute inset-0 w-full h-full object-cover"
                                         />
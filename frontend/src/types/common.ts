@@ -6,4 +6,13 @@ export type LlmConnection = {
 export enum LlmModels {
     'gpt4o' = 'gpt-4o',
     'gpt4omini' = 'gpt-4o-mini',
-}
\ No newline at end of file
+}
+
+export type StreamEvent =
+    | { type: 'job'; id: string }
+    | { type: 'progress'; scanned: number; total: number }
+    | { type: 'keyframe'; index: number; frame_index: number; frame: string | null; frame_id: string | null; url: string | null; frame_type: string; duplicate_of: number | null; bytes: number; encode_ms: number }
+    | { type: 'analyzing'; keyframes: number }
+    | { type: 'analysis'; delta: string }
+    | { type: 'done'; output: string }
+    | { type: 'error'; status: number; detail: string }